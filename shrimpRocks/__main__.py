@@ -11,6 +11,9 @@
 # sudo apt install python3-skimage  # scikit-image
 # sudo pip install opencv-contrib-python --break-system-packages
 
+import time
+_startTime = time.perf_counter()
+
 import argparse
 import sys
 import os
@@ -22,21 +25,32 @@ _imageAnalysedDir = os.path.join(_imageDir, "analysed/")
 _imageTestDir = os.path.join(_imageDir, "test/")
 # _settingsFile = os.path.join(_imageDir, "shrimpsettings.json")
 _oneCentimetre = 75  # pixels
+_samCacheDir = ".samcache/"
+_samEmbedDir = ".samembed/"
+_samOnnxDir = ".samonnx/"
+_samQuantDir = ".samquant/"
+_samCompileDir = ".samcompile/"
 
 from shrimpRocks.getFiles import GetFiles
 from shrimpRocks.imgUtilities import ImageUtilities
 from shrimpRocks.imgCropping import ImageCropping
-from shrimpRocks.clkImage import ClickImage
-from shrimpRocks.imgAnalyse import ImageAnalyse
-from shrimpRocks.imgReadme import ImageReadme
+from shrimpRocks.samServer import SAMserver, SAMclient, defaultAddress
+# the SAM, analysis and plotting modules are imported by the modes that use them,
+# so cropping and the server commands start without loading torch or matplotlib
+
+def startupTime(args, mode: str):
+    """
+    With --timing, print how long the mode took to be ready to start work.
+    """
+    if args.timing:
+        print(f"startup ({mode}): {time.perf_counter() - _startTime:.3f}s")
+    return
 
 def main():
     
     getfiles = GetFiles()
     imgUtils = ImageUtilities()
     imgCropping = ImageCropping(_imageDir)
-    imgAnalyse = ImageAnalyse(_oneCentimetre)
-    clkImage = ClickImage(_oneCentimetre)
     
     desc = f"""Futility for measuring pebble sizes on Chesil Beach.\n
     Image numbers are in the range 1 to 33 and correspond to those found in the {_sourceDir} or {_imageCroppedDir} directories"""
@@ -47,27 +61,218 @@ def main():
     parser.add_argument('--croptest', type=int, help='Use the image number to test an individual image, for checking the crop process is working.', default=0)
     parser.add_argument('--segment', type=int, help='Filer Test, using the image number display an indivdual rock image with the filters applied.')
     parser.add_argument('--chug', type=int, default=None, help=f'Filter Test, use an image number for testing a filter with a range of values, files are output to {_imageTestDir}.')      
+    parser.add_argument('--sweep', type=str, action='append', default=None, help='With --chug, a filter setting and its values, filter.param=start:stop:step or filter.param=v1,v2,... e.g. roundish.0=0.3:1.0:0.04, give more than one for a grid.')
+    parser.add_argument('--chugfilters', type=str, default=None, help='With --chug, a comma separated list of the filters applied, by default minimumSize,touchingEdges,roundish.')
     parser.add_argument('--makereadme', type=int, default=None, help=f'Make images for the readme.md file using an image number.')
     parser.add_argument('--clickimage', type=int, default=None, help=f'Using an image number, loads a filtered image, allows you to click on the masks for information about the mask.')
+    parser.add_argument('--nocache', action='store_true', help=f'Do not read or write the SAM mask cache in {_samCacheDir} or the image embedding cache in {_samEmbedDir}, the masks are always generated.')
+    parser.add_argument('--clearcache', action='store_true', help=f'Delete all the cached SAM masks in {_samCacheDir} and image embeddings in {_samEmbedDir}.')
+    parser.add_argument('--server', action='store_true', help='Run a SAM server that keeps the model loaded, other commands use it while it is running. Start it in a separate terminal or in the background.')
+    parser.add_argument('--stopserver', action='store_true', help='Stop a running SAM server.')
+    parser.add_argument('--noserver', action='store_true', help='Do not use a running SAM server, always load the model in this process.')
+    parser.add_argument('--duplicates', action='store_true', help='With --averagesize and --segment, remove the repeated and nested SAM masks before the other filters, fewer masks to filter but the pebbles measured can change.')
+    parser.add_argument('--batchsize', type=int, default=1, help='With --averagesize, the number of images the SAM image encoder processes per forward pass.')
+    parser.add_argument('--pipeline', type=int, default=0, help='With --averagesize, read ahead and filter/save the images on this many threads while SAM runs, 0 runs each image in turn.')
+    parser.add_argument('--workers', type=int, default=1, help='With --averagesize, share the images between this many processes, the model is loaded once and shared between them. With --process, crop this many source images at a time.')
+    parser.add_argument('--ruler', type=str, default="hough", choices=["hough", "profile"], help='With --process and --croptest, how the ruler edges are found, profile is faster and falls back to hough when the edges are not clear.')
+    parser.add_argument('--cropbench', action='store_true', help='Compare the ruler edges and time per source image of the projection profile and Hough line detectors.')
+    parser.add_argument('--batchbench', type=str, default=None, help='Report the SAM throughput in images/minute for a comma separated list of batch sizes, e.g. 1,2,4')
+    parser.add_argument('--filterbench', action='store_true', help='Report the filter time per image with full frame masks and with the masks cropped to their boxes.')
+    parser.add_argument('--benchimages', type=int, default=None, help='Limit the benchmarks to the first N cropped images.')
+    parser.add_argument('--preset', type=str, default="default", choices=["default", "fast", "balanced", "thorough"], help='Speed/quality preset for the SAM mask generator, default uses the Segment Anything defaults.')
+    parser.add_argument('--pointsperside', type=int, default=None, help='Mask generator override: points_per_side, the number of points is this squared.')
+    parser.add_argument('--pointsperbatch', type=int, default=None, help='Mask generator override: points_per_batch, points decoded together.')
+    parser.add_argument('--prediouthresh', type=float, default=None, help='Mask generator override: pred_iou_thresh.')
+    parser.add_argument('--stabilitythresh', type=float, default=None, help='Mask generator override: stability_score_thresh.')
+    parser.add_argument('--croplayers', type=int, default=None, help='Mask generator override: crop_n_layers.')
+    parser.add_argument('--minregionarea', type=int, default=None, help='Mask generator override: min_mask_region_area.')
+    parser.add_argument('--presetreport', type=str, default=None, help='Report the SAM time and average cm^2 per image for a comma separated list of presets, e.g. fast,balanced,thorough')
+    parser.add_argument('--model', type=str, default="vit_h", choices=["vit_h", "vit_l", "vit_b", "vit_t"], help='The SAM backbone, vit_h is the most accurate and the slowest, vit_t is MobileSAM.')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint file for the --model backbone, by default the standard file name in the current directory.')
+    parser.add_argument('--comparemodels', type=str, default=None, help='Compare SAM backbones over the cropped images against the first one listed, e.g. vit_h,vit_l,vit_b')
+    parser.add_argument('--runtime', type=str, default="torch", choices=["torch", "onnx"], help='Run SAM with PyTorch or with ONNX Runtime on the CPU, onnx needs --onnxexport first.')
+    parser.add_argument('--onnxexport', action='store_true', help=f'Export the SAM encoder and decoder for --model to ONNX in {_samOnnxDir}.')
+    parser.add_argument('--onnxparity', action='store_true', help='Compare the ONNX Runtime masks and measurements with the torch ones on the cropped images.')
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "int8", "bf16"], help='Precision of the SAM image encoder on the torch runtime, int8 and bf16 are faster on the CPU.')
+    parser.add_argument('--precisionreport', type=str, default=None, help='Compare encoder precisions over the cropped images against the first one listed, e.g. fp32,int8,bf16')
+    parser.add_argument('--cputune', action='store_true', help='Torch runtime: run SAM with CPU tuned thread and memory layout settings in inference mode, and print the encoder and decoder time for each image.')
+    parser.add_argument('--compile', action='store_true', help=f'As --cputune with the image encoder compiled by torch.compile, the compiled code is cached in {_samCompileDir}.')
+    parser.add_argument('--backend', type=str, default="sam", choices=["sam", "watershed"], help='Segmenter for --averagesize, --segment, --chug and --clickimage, watershed is a fast classical segmenter that needs no model.')
+    parser.add_argument('--prompt', type=str, default="grid", choices=["grid", "seeded"], help='Where SAM is prompted, grid is the mask generator point grid, seeded is one point per pebble found by a quick classical pass, which is far fewer points to decode.')
+    parser.add_argument('--backendreport', type=str, default=None, help='Compare the segmentation time and average cm^2 per image of the backends over the cropped images, e.g. sam,watershed')
+    parser.add_argument('--timing', action='store_true', help='Print the time taken to start the chosen mode, from launch to the point it begins work.')
+    parser.add_argument('--serveraddress', type=str, default=defaultAddress(), help='Unix socket path or localhost:port for the SAM server.')
 
     args = parser.parse_args()
+    imgCropping.rulerDetector = args.ruler
     
     if len(sys.argv) == 1:
         parser.print_help()
         return   
     
+    samSettings = {"USE_CACHE": not args.nocache, "CACHE_DIR": _samCacheDir,
+                   "USE_EMBED_CACHE": not args.nocache, "EMBED_CACHE_DIR": _samEmbedDir,
+                   "USE_SERVER": not args.noserver, "SERVER_ADDRESS": args.serveraddress,
+                   "PRESET": args.preset,
+                   "GENERATOR_OVERRIDES": {
+                       "points_per_side": args.pointsperside,
+                       "points_per_batch": args.pointsperbatch,
+                       "pred_iou_thresh": args.prediouthresh,
+                       "stability_score_thresh": args.stabilitythresh,
+                       "crop_n_layers": args.croplayers,
+                       "min_mask_region_area": args.minregionarea},
+                   "MODEL_TYPE": args.model, "CHECKPOINT": args.checkpoint,
+                   "RUNTIME": args.runtime, "ONNX_DIR": _samOnnxDir,
+                   "PRECISION": args.precision, "QUANT_DIR": _samQuantDir,
+                   "CPU_TUNE": args.cputune, "COMPILE": args.compile, "COMPILE_DIR": _samCompileDir,
+                   "BACKEND": args.backend, "PROMPT": args.prompt}
+    
+    if args.clearcache:
+        from shrimpRocks.samCache import MaskCache, EmbeddingCache
+        
+        startupTime(args, "clearcache")
+        removed = MaskCache(_samCacheDir).clear()
+        print(f"removed {removed} cached mask files from: {_samCacheDir}")
+        removed = EmbeddingCache(_samEmbedDir).clear()
+        print(f"removed {removed} cached image embeddings from: {_samEmbedDir}")
+        return
+    
+    if args.server:
+        from shrimpRocks.samProcess import SAMprocess
+        
+        samServer = SAMserver(SAMprocess(samSettings), args.serveraddress)
+        startupTime(args, "server")
+        samServer.serve()
+        return
+    
+    if args.stopserver:
+        startupTime(args, "stopserver")
+        if SAMclient(args.serveraddress).shutdown():
+            print(f"SAM server at {args.serveraddress} stopped")
+        else:
+            print(f"no SAM server running at: {args.serveraddress}")
+        return
+    
     if args.averagesize:        
         images = getfiles.filesList(_imageCroppedDir)
         if images is None:
             print (f"no cropped images found in: {_imageCroppedDir}")
             return
             
+        from shrimpRocks.imgAnalyse import ImageAnalyse
+        
+        imgAnalyse = ImageAnalyse(_oneCentimetre, samSettings=samSettings, duplicates=args.duplicates)
+        startupTime(args, "averagesize")
         getfiles.makeOutputDir(_imageAnalysedDir)
         getfiles.deleteFiles(_imageAnalysedDir)
-        sizes = imgAnalyse.makeAverageSizes(images, _imageAnalysedDir)
+        sizes = imgAnalyse.makeAverageSizes(images, _imageAnalysedDir, args.batchsize, args.pipeline, args.workers)
         imgAnalyse.plotAverageSizes(sizes, _imageDir)
         return
     
+    if args.batchbench:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        batchSizes = [int(b) for b in args.batchbench.split(",") if b.strip()]
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "batchbench")
+        imgBench.batchThroughput(images[:args.benchimages], batchSizes)
+        return
+    
+    if args.filterbench:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "filterbench")
+        imgBench.filterTiming(images[:args.benchimages], os.path.join(_imageDir, "filter_timing.csv"))
+        return
+    
+    if args.presetreport:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        presets = [p.strip() for p in args.presetreport.split(",") if p.strip()]
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "presetreport")
+        imgBench.presetReport(images[:args.benchimages], presets, os.path.join(_imageDir, "preset_report.csv"))
+        return
+    
+    if args.comparemodels:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        modelTypes = [m.strip() for m in args.comparemodels.split(",") if m.strip()]
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "comparemodels")
+        imgBench.modelComparison(images[:args.benchimages], modelTypes, os.path.join(_imageDir, "model_comparison.csv"))
+        return
+    
+    if args.backendreport:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        backends = [b.strip() for b in args.backendreport.split(",") if b.strip()]
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "backendreport")
+        imgBench.backendReport(images[:args.benchimages], backends, os.path.join(_imageDir, "backend_report.csv"))
+        return
+    
+    if args.onnxexport:
+        from shrimpRocks.samProcess import SAMprocess
+        
+        samProc = SAMprocess(samSettings)
+        startupTime(args, "onnxexport")
+        samProc.exportOnnx()
+        return
+    
+    if args.onnxparity:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "onnxparity")
+        imgBench.onnxParity(images[:args.benchimages], os.path.join(_imageDir, "onnx_parity.csv"))
+        return
+    
+    if args.precisionreport:
+        images = getfiles.filesList(_imageCroppedDir)
+        if images is None:
+            print (f"no cropped images found in: {_imageCroppedDir}")
+            return
+        
+        precisions = [p.strip() for p in args.precisionreport.split(",") if p.strip()]
+        from shrimpRocks.imgBenchmark import ImageBenchmark
+        
+        imgBench = ImageBenchmark(_oneCentimetre, samSettings)
+        startupTime(args, "precisionreport")
+        imgBench.precisionReport(images[:args.benchimages], precisions, os.path.join(_imageDir, "precision_report.csv"))
+        return
+    
     if args.clickimage:
         imgID = args.clickimage
         images = getfiles.filesList(_imageCroppedDir)       
@@ -76,6 +281,10 @@ def main():
             print(f"Image {imgID} not found")
             return
         
+        from shrimpRocks.clkImage import ClickImage
+        
+        clkImage = ClickImage(_oneCentimetre, samSettings=samSettings)
+        startupTime(args, "clickimage")
         clkImage.makeClickImage(filename)
         return
     
@@ -87,6 +296,10 @@ def main():
             print(f"Image {imgID} not found")
             return
         
+        from shrimpRocks.imgAnalyse import ImageAnalyse
+        
+        imgAnalyse = ImageAnalyse(_oneCentimetre, samSettings=samSettings, duplicates=args.duplicates)
+        startupTime(args, "segment")
         imgAnalyse.runSegment(filename)
         return
             
@@ -98,29 +311,40 @@ def main():
             print(f"Image {imgID} not found")
             return        
                           
+        startupTime(args, "croptest")
         img, testImg = imgCropping.selectInsideYellowSquare(filename, True)    
+        if img is None:
+            print(f"the ruler edges were not found in: {filename}")
+            imgUtils.showImage(testImg)
+            return
         output_image = imgUtils.concat_same_height(testImg, img)
         print ("On the left, showing the verticals and horizontals selected in red and green, and right, the cropped area")
         print ("press any key while inside the image to exit")
         imgUtils.showImage(output_image)
         return
     
+    if args.cropbench:
+        images = getfiles.filesList(_sourceDir)
+        if images is None:
+            print (f"no source images found in: {_sourceDir}")
+            return
+        
+        startupTime(args, "cropbench")
+        imgCropping.compareDetectors(images[:args.benchimages])
+        return
+    
     if args.process:
         images = getfiles.filesList(_sourceDir)
         if images is None:
             print (f"no cropped images found in: {_imageCroppedDir}")
             return        
         
+        startupTime(args, "process")
         getfiles.makeOutputDir(_imageCroppedDir)
         getfiles.deleteFiles(_imageCroppedDir)
         
         print(f"cropping source images to: {_imageCroppedDir}")        
-        c=1
-        for i in images:
-            img, _ = imgCropping.selectInsideYellowSquare(i)
-            filename = os.path.join(_imageCroppedDir,f"rocks_{str(c).zfill(2)}.png")      
-            imgUtils.saveImage(filename, img)
-            c+=1
+        imgCropping.cropImages(images, _imageCroppedDir, args.workers)
     
         print("done")
         return
@@ -133,7 +357,10 @@ def main():
             print(f"Image {imgID} not found, or file {filename} not found")
             return
                 
-        imgReadme = ImageReadme(_oneCentimetre, _sourceDir)
+        from shrimpRocks.imgReadme import ImageReadme
+        
+        imgReadme = ImageReadme(_oneCentimetre, _sourceDir, samSettings)
+        startupTime(args, "makereadme")
         output_dir = os.path.join(_imageDir, "readmeImgs/")
         getfiles.makeOutputDir(output_dir)
         getfiles.deleteFiles(output_dir)
@@ -152,7 +379,12 @@ def main():
         chugTestDir = os.path.join(_imageDir, "chugtest/")
         getfiles.makeOutputDir(chugTestDir)
         getfiles.deleteFiles(chugTestDir)          
-        imgAnalyse.chugSegment(filename, imgID, chugTestDir)
+        from shrimpRocks.imgAnalyse import ImageAnalyse
+        
+        imgAnalyse = ImageAnalyse(_oneCentimetre, samSettings=samSettings)
+        startupTime(args, "chug")
+        chugFilters = [f.strip() for f in args.chugfilters.split(",") if f.strip()] if args.chugfilters else None
+        imgAnalyse.chugSegment(filename, imgID, chugTestDir, args.sweep, chugFilters)
         return
 
     return
@@ -4,20 +4,21 @@
 import os
 import cv2
 import numpy as np
-import math 
 import traceback
-import matplotlib.pyplot as plt
 from pathlib import Path
 from PIL import ImageFont, ImageDraw, Image
 
 from shrimpRocks.imgUtilities import ImageUtilities
 from shrimpRocks.imgFilters import ImageFilters
-from shrimpRocks.samProcess import SAMprocess
+from shrimpRocks.watershedProcess import makeSegmenter
+from shrimpRocks.maskSet import MaskSet
+from shrimpRocks.occlusionMap import OcclusionMap
 
 class ClickImage:
     
-    def __init__(self, oneCentimetre=75, outDir=None, font_size=24):
+    def __init__(self, oneCentimetre=75, outDir=None, font_size=24, samSettings=None):
         self.oneCentimetre = oneCentimetre  # pixels 
+        self.samSettings = samSettings
         self.windowTitle = "Click Image"
         self.outDir = outDir
         self.font_size = font_size
@@ -65,86 +66,20 @@ class ClickImage:
         outline_color = (0, 0, 255)  # BGR
         outline_thickness = 2        
                
-        for mask_data in filtered_masks:
-            mask = mask_data['segmentation'].astype(np.uint8) * 255
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for i in range(len(filtered_masks)):
+            contours = filtered_masks.contours(i)
             cv2.drawContours(output_image, contours, -1, outline_color, outline_thickness)
 
         return output_image
 
-    def convexHullDiff(self, contour):
-        
-        hull_points = cv2.convexHull(contour, returnPoints=True)
-        if len(hull_points) < 3:
-            return 0,0,0,0
-        
-        contour_area = cv2.contourArea(contour)
-        hull_area = cv2.contourArea(hull_points)
-        contour_perimeter = cv2.arcLength(contour, True)
-        hull_perimeter = cv2.arcLength(hull_points, True)
-
-        hull_defect_area = max(hull_area - contour_area, 0.0)
-        hull_defect_ratio = hull_defect_area / (hull_area + 1e-6)
-        perimeter_difference = contour_perimeter - hull_perimeter
-        perimeter_defect_ratio = perimeter_difference / (hull_perimeter + 1e-6)
-
-        return {
-            "contour_area": contour_area,
-            "contour_perimeter": contour_perimeter,
-            "hull_perimeter": hull_perimeter,
-            "hull_area": hull_area,
-            "hull_defect_area": hull_defect_area,
-            "hull_defect_ratio": hull_defect_ratio,
-            "perimeter_difference": perimeter_difference,
-            "perimeter_defect_ratio": perimeter_defect_ratio 
-        }
-    
-    def complexity(self, contour, epsilon_factor):
-        
-        perimeter = cv2.arcLength(contour, True)
-        epsilon = epsilon_factor * perimeter
-        approx = cv2.approxPolyDP(contour, epsilon, True)        
-        num_vertices = len(approx)
-        
-        return {
-            "perimeter": perimeter,
-            "epsilon": epsilon,
-            "num_vertices": num_vertices
-        }
-
-    def occluded(self, mask, exclusion_mask, iou_thresh, overlap_self_thresh):
-        
-        # work with boolean masks
-        cur = (mask > 0)
-        prev = (exclusion_mask > 0)
-
-        inter = np.logical_and(cur, prev).sum()
-        info = {
-            "occluded": False,
-            "iou": 0.0,
-            "overlap_self": 0.0
-        }
-        if inter == 0:
-            # no overlap: keep and update
-            return info, cv2.bitwise_or(exclusion_mask, mask)
-
-        area_cur = cur.sum()
-        area_prev = prev.sum()
-        union = area_cur + area_prev - inter
-
-        iou = inter / (union + 1e-6)
-        overlap_self = inter / (area_cur + 1e-6)
-        is_occluded = (iou > iou_thresh) or (overlap_self > overlap_self_thresh)
-        info.update({"occluded": is_occluded, "iou": iou, "overlap_self": overlap_self})
-        if not is_occluded:
-            exclusion_mask = cv2.bitwise_or(exclusion_mask, mask)
-        return info, exclusion_mask        
-        
-
-    def makeMaskEntries(self, image, filtered_masks, imgFilters):
+    def makeMaskEntries(self, image, filtered_masks: MaskSet, imgFilters):
+        """
+        The measurements shown for each mask, the masks themselves stay in filtered_masks
+        and each entry refers to its mask by index.
+        """
         imgFilters = ImageFilters()
         
-        exclusion_mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        occlusionMap = OcclusionMap(image.shape)
         
         ## using the same default values as in ImageFilters
         iou_thresh = imgFilters.defaults['IOU_THRESH']
@@ -153,45 +88,40 @@ class ClickImage:
         
         mask_entries = []
         rng = np.random.default_rng(12345)
-        for mask_data in filtered_masks:
-            mask_bool = mask_data["segmentation"].astype(bool)
-            mask_uint8 = (mask_bool.astype(np.uint8) * 255)
-                        
-            contours, _ = cv2.findContours(mask_uint8.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            contour = imgFilters.minimumContourFilter(contours)
-            if contour is None:
+        # every measurement comes from the one pass over the masks
+        features = imgFilters.maskFeatures(filtered_masks, epsilon_factor=epsilon_factor)
+        for i in range(len(filtered_masks)):
+            f = features[i]
+            if f["contourPoints"] == 0 or f["contourPoints"] < imgFilters.defaults['MIN_CONTOURS']:
                 continue
             
-            hull = self.convexHullDiff(contour)            
-            solidity = hull["contour_area"] / (hull["hull_area"] + 1e-6)
-            roundness = 0.0
-            if hull["contour_perimeter"] > 0 and hull["contour_area"] > 0:
-                roundness = 4 * math.pi * hull["contour_area"] / (hull["contour_perimeter"] ** 2)
+            contour = imgFilters.largestContour(filtered_masks, i)
+            solidity = f["contourArea"] / (f["hullArea"] + 1e-6)
+            hull_diff = max(f["hullArea"] - f["contourArea"], 0.0)
             bbox = cv2.boundingRect(contour)
             color = tuple(int(c) for c in rng.integers(90, 255, size=3))
 
-            occlusion_info, exclusion_mask = self.occluded(mask_uint8, exclusion_mask, iou_thresh, overlap_self_thresh)
-            complex = self.complexity(contour, epsilon_factor)
+            occlusion_info = occlusionMap.check(filtered_masks, i, iou_thresh, overlap_self_thresh)
             
             mask_entries.append(
                 {
-                    "mask": mask_bool,
+                    "maskIndex": i,
                     "bbox": bbox,
                     "color": color,                    
                     
                     "contour": contour,
-                    "contour_points": len(contour),
-                    "contour_area": hull["contour_area"],
-                    "contour_perimeter": hull["contour_perimeter"],
-                    "perimeter_diff": hull["perimeter_difference"],
-                    "solidity": solidity,
-                    "hull_diff": hull["hull_defect_area"],
-                    "hull_diff_ratio": hull["hull_defect_ratio"],
-                    "roundness": roundness,
+                    "contour_points": int(f["contourPoints"]),
+                    "contour_area": float(f["contourArea"]),
+                    "contour_perimeter": float(f["perimeter"]),
+                    "perimeter_diff": float(f["perimeter"] - f["hullPerimeter"]),
+                    "solidity": float(solidity),
+                    "hull_diff": float(hull_diff),
+                    "hull_diff_ratio": float(hull_diff / (f["hullArea"] + 1e-6)),
+                    "roundness": float(f["roundness"]),
                     
-                    "perimeter": complex["perimeter"],
-                    "epsilon": complex["epsilon"],
-                    "num_vertices": complex["num_vertices"],
+                    "perimeter": float(f["perimeter"]),
+                    "epsilon": float(epsilon_factor * f["perimeter"]),
+                    "num_vertices": int(f["vertices"]),
                     
                     "occluded": occlusion_info["occluded"],
                     "iou": occlusion_info["iou"],
@@ -251,10 +181,11 @@ class ClickImage:
         
         imgFilters = ImageFilters()
         imgUtilities = ImageUtilities()
-        samProc = SAMprocess()   
+        samProc = makeSegmenter(self.samSettings)   
         
         screen_width, screen_height = imgUtilities.getCurrentScreenRes()
         filters_config = [
+            ("duplicates", "Duplicates"),
             ("touchingEdges", "Touch Edges"),
             ("minimumSize", "Minimum Size"),
             ("occluded", "Occluded"),
@@ -264,18 +195,22 @@ class ClickImage:
             ("roundish", "Roundish"),
         ]
         filter_states = {name: 1 for name, _ in filters_config}
+        # off by default, as with --averagesize
+        filter_states["duplicates"] = 0
         
         print(f"loading image: {image_file}")
         # 1. Initialization (Run SAM only once)
-        mask_generator = samProc.load_sam()
         image, image_rgb = samProc.load_image(image_file)
-        sam_masks = samProc.generate_masks(mask_generator, image_rgb)
+        sam_masks = samProc.get_masks(image_rgb)
+        # applyfilters keeps each filter's result here, so a toggle only reruns the filters after it
+        filter_memo = {}
         
         print("You can toggle filters using the checkboxes on the right.")
-        print("Updating the filters can take a few seconds and during that time it appears that nothing is happening.")
+        print("The first update of the filters can take a few seconds and during that time it appears that nothing is happening,")
+        print("after that only the filters from the one changed onwards are run again.")
         
         current_image = image.copy()
-        filtered_masks: list[dict] = []
+        filtered_masks = MaskSet(image.shape)
         mask_entries: list[dict] = []
         # get the default values from ImageFilters, used in the output.
         filter_defaults = imgFilters.defaults
@@ -318,7 +253,8 @@ class ClickImage:
             if highlighted_idx is not None and 0 <= highlighted_idx < len(mask_entries):
                 entry = mask_entries[highlighted_idx]
                 overlay = np.zeros_like(vis)
-                overlay[entry["mask"]] = entry["color"]
+                mx, my, mw, mh = filtered_masks.boxes[entry["maskIndex"]]
+                overlay[my:my + mh, mx:mx + mw][filtered_masks.crop(entry["maskIndex"])] = entry["color"]
                 vis = cv2.addWeighted(vis, 0.65, overlay, 0.35, 0.0)
                 cv2.drawContours(vis, [entry["contour"]], -1, (0, 255, 0), 2)
                 x, y, w, h = entry["bbox"]
@@ -402,7 +338,7 @@ class ClickImage:
             cv2.imshow(window_name, display_image)
             cv2.waitKey(1)
             try:
-                filtered_masks, _ = imgFilters.applyfilters(image, sam_masks, filterList=selected_filters)
+                filtered_masks, _ = imgFilters.applyfilters(image, sam_masks, filterList=selected_filters, memo=filter_memo)
                 if filtered_masks:
                     current_image = self.drawAllOutlines(image, filtered_masks)
                     mask_entries = self.makeMaskEntries(image, filtered_masks, imgFilters)
@@ -445,8 +381,7 @@ class ClickImage:
             x_orig = int(round(x / scale))
             y_orig = int(round(y / scale))
             for idx in range(len(mask_entries) - 1, -1, -1):
-                mask = mask_entries[idx]["mask"]
-                if 0 <= y_orig < mask.shape[0] and 0 <= x_orig < mask.shape[1] and mask[y_orig, x_orig]:
+                if filtered_masks.contains(mask_entries[idx]["maskIndex"], x_orig, y_orig):
                     selected = idx
                     # print(f"pebble selected {selected} ")
                     break
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import csv
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from shrimpRocks.imgFilters import ImageFilters
+from shrimpRocks.maskSet import MaskSet
+
+
+class FilterSweep():
+    """
+    Runs the filters over one image for every value, or grid of values, of one or more
+    filter settings. A setting is given as filter.param=values where param is the position
+    in the filter's testVal list (see ImageFilters.applyfilters) and values is either
+    start:stop:step (stop not included) or a comma separated list, e.g.
+        roundish.0=0.30:1.0:0.04
+        occluded.0=0.3,0.5,0.7
+    The filters after the occlusion filter only compare a column of the feature table with
+    the value, so for those the masks are measured once and each value costs one comparison
+    per mask. Changing an earlier filter changes which masks reach the occlusion filter,
+    those settings re-run the filters from the one changed, using applyfilters' memo.
+    """
+
+    def __init__(self, imgFilters: ImageFilters=None):
+        self.imgFilters = imgFilters or ImageFilters()
+        self.afterOcclusion = self.imgFilters.stages[self.imgFilters.stages.index("occluded") + 1:]
+        return
+
+    def parseSweep(self, spec: str) -> tuple:
+        """
+        "filter.param=values" to (filter, param, [value, ...]).
+        """
+        try:
+            name, values = spec.split("=", 1)
+            filter, param = name.split(".", 1) if "." in name else (name, "0")
+            param = int(param)
+            if ":" in values:
+                start, stop, step = (float(v) for v in values.split(":"))
+                count = int(np.floor((stop - start) / step - 1e-9)) + 1
+                values = [round(start + step * k, 10) for k in range(max(count, 0))]
+            else:
+                values = [float(v) for v in values.split(",") if v.strip()]
+        except ValueError:
+            print(f"Cannot read the sweep: {spec}, use filter.param=start:stop:step or filter.param=v1,v2,...")
+            sys.exit()
+
+        internal = ("features", "minimumPerimeter")
+        if filter not in self.imgFilters.stages or filter in internal or not 0 <= param <= 2:
+            filters = [f for f in self.imgFilters.stages if f not in internal]
+            print(f"Unknown sweep filter: {filter}.{param}, available: {', '.join(filters)} with param 0 to 2")
+            sys.exit()
+        if not values:
+            print(f"No values to sweep in: {spec}")
+            sys.exit()
+
+        # the integer settings, MIN_CONTOURS, MIN_AREA and so on, compare the same either way
+        return filter, param, values
+
+    def isThreshold(self, filter: str, param: int) -> bool:
+        """
+        True when the setting only changes a comparison after the occlusion filter, the
+        complexity epsilon_factor changes the vertex count in the feature table so it is not.
+        """
+        return filter in self.afterOcclusion and (filter, param) != ("complexity", 0)
+
+    def makeTestVal(self, settings: dict) -> list:
+        """
+        {(filter, param): value} to applyfilters' testVal.
+        """
+        vals = {}
+        for (filter, param), value in settings.items():
+            vals.setdefault(filter, [None, None, None])[param] = value
+        return [{"filter": f, "val": v} for f, v in vals.items()]
+
+    def run(self, image: np.ndarray, sam_masks: MaskSet, filterList: list, sweeps: list) -> list:
+        """
+        Returns a row per point of the grid, in itertools.product order:
+        {"settings": {(filter, param): value}, "kept": [mask indices]}.
+        """
+        height, width = image.shape[:2]
+        filterList = list(filterList) + [f for f, _, _ in sweeps if f not in filterList]
+        structural = [s for s in sweeps if not self.isThreshold(s[0], s[1])]
+        thresholds = [s for s in sweeps if self.isThreshold(s[0], s[1])]
+        earlyFilters = [f for f in filterList if f not in self.afterOcclusion]
+        lateFilters = [f for f in filterList if f in self.afterOcclusion]
+
+        memo = {}
+        rows = []
+        for structValues in itertools.product(*[values for _, _, values in structural]):
+            structSettings = {(f, p): v for (f, p, _), v in zip(structural, structValues)}
+            testVal = self.makeTestVal(structSettings)
+            kept, features = self.imgFilters.keptMasks(image, sam_masks, earlyFilters, testVal, memo=memo)
+            base = np.zeros(len(sam_masks), dtype=bool)
+            base[kept] = True
+
+            # each late filter's result for each of its values, a comparison over the table
+            passes = {}
+            def passing(filter: str, settings: dict) -> np.ndarray:
+                values = tuple(settings.get((filter, p)) for p in range(3))
+                if (filter, values) not in passes:
+                    passes[(filter, values)] = self.imgFilters.featureFilter(features, filter, list(values), height, width)
+                return passes[(filter, values)]
+
+            for threshValues in itertools.product(*[values for _, _, values in thresholds]):
+                settings = dict(structSettings)
+                settings.update({(f, p): v for (f, p, _), v in zip(thresholds, threshValues)})
+                keep = base.copy()
+                for filter in lateFilters:
+                    keep &= passing(filter, settings)
+                rows.append({"settings": settings, "kept": [i for i in kept if keep[i]]})
+
+        # back to the order of the sweeps for the output
+        names = [(f, p) for f, p, _ in sweeps]
+        rows.sort(key=lambda r: tuple(next(k for k, v in enumerate(values) if v == r["settings"][(f, p)])
+                                      for (f, p, values) in sweeps))
+        for row in rows:
+            row["settings"] = {n: row["settings"][n] for n in names}
+        return rows
+
+    def saveImages(self, rows: list, makeImage, outFiles: list, workers: int=None):
+        """
+        Draw and save an image per row on a pool of threads, OpenCV's drawing and PNG
+        writing release the GIL.
+        """
+        import cv2
+
+        def save(args):
+            row, outFile = args
+            cv2.imwrite(outFile, makeImage(row))
+            return outFile
+
+        with ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+            for outFile in pool.map(save, zip(rows, outFiles)):
+                print(f"saved: {outFile}")
+        return
+
+    def writeCSV(self, filename: str, rows: list, columns: list):
+
+        try:
+            with open(filename, "w", newline="") as csvFile:
+                writer = csv.DictWriter(csvFile, fieldnames=columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(rows)
+        except Exception as e:
+            print(f"Cannot write to file: {filename}")
+            print(e)
+            return
+
+        print(f"sweep results saved to: {filename}")
+        return
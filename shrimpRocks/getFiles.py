@@ -3,6 +3,7 @@
 
 import sys
 import os
+import re
 from natsort import natsorted
 import json
 
@@ -56,11 +57,25 @@ class GetFiles():
         
         return
     
+    def fileNumber(self, filename: str, default: int=None) -> int:
+        """
+        The NN of a rocks_NN.png file, which is the number of the source image it was cropped from.
+        """
+        match = re.fullmatch(r"rocks_(\d+)\.png", os.path.basename(filename))
+        if match is None:
+            return default
+        return int(match.group(1))
+    
     def isRockfordFile(self, files: list, id: int) -> str:
         
         if files is None:
             return None
         
+        # the cropped images keep their source number, there is a gap where a source could not be cropped
+        numbers = [self.fileNumber(filename) for filename in files]
+        if any(n is not None for n in numbers):
+            return files[numbers.index(id)] if id in numbers else None
+        
         try:
             filename = files[id-1]
         except:
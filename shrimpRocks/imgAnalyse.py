@@ -5,19 +5,58 @@ import os
 import cv2
 import numpy as np
 import math 
+import time
+import csv
+import json
 import traceback
-import matplotlib.pyplot as plt
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from shrimpRocks.imgUtilities import ImageUtilities
+from shrimpRocks.getFiles import GetFiles
 from shrimpRocks.imgFilters import ImageFilters
 from shrimpRocks.samProcess import SAMprocess
+from shrimpRocks.watershedProcess import makeSegmenter
+from shrimpRocks.imgPipeline import ImagePipeline
+from shrimpRocks.filterSweep import FilterSweep
+
+# set by ImageAnalyse.shardedSizes just before the workers are forked, so the loaded
+# model is inherited by them rather than pickled
+_shardJob = {}
+
+def _shardInit(threads: int, usesTorch: bool):
+    # keep workers x threads within the CPU count
+    if usesTorch:
+        import torch
+        
+        torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+def _shardRun(shard: list) -> tuple:
+    """
+    Measure one worker's share of the images, returns ([(index, size), ...], seconds).
+    """
+    job = _shardJob
+    start = time.perf_counter()
+    sizes = job["imgAnalyse"].analyseImages(job["samProc"], [f for _, f in shard], job["imageAnalyseDir"],
+                                            job["batchSize"], job["pipelineWorkers"])
+    return list(zip([i for i, _ in shard], sizes)), time.perf_counter() - start
 
 class ImageAnalyse():
     
-    def __init__(self, oneCentimetre=75, outDir=None):
+    def __init__(self, oneCentimetre=75, outDir=None, samSettings=None, duplicates=False):
         self.oneCentimetre = oneCentimetre  # pixels 
         self.windowTitle = "Image Analyse"
         self.outDir = outDir
+        self.samSettings = samSettings
+        # remove SAM's repeated masks first, this can change which pebbles are measured
+        self.duplicates = duplicates
+        # the filters applied when measuring the average sizes
+        self.filterList = ["minimumSize","touchingEdges","occluded", "wholeness", "convexHull", "complexity", "roundish"]
+        if duplicates:
+            self.filterList.insert(0, "duplicates")
         return
     
     def calculate_average_size(self, areas: list) -> tuple:
@@ -53,38 +92,172 @@ class ImageAnalyse():
         cmArea = (pxArea / (self.oneCentimetre * self.oneCentimetre))        
         return cmArea
     
-    def makeAverageSizes(self, image_list: list, imageAnalyseDir: str) -> list:
-        samProc = SAMprocess() 
+    def measureImage(self, samProc, imgFilters, imageUtils, image_file: str, image, sam_masks: list, imageAnalyseDir: str) -> dict:
+        """
+        Filter the masks for one image, save the overlay and return its average size.
+        """
+        filterStats = []
+        filtered_masks, pebble_data = imgFilters.applyfilters(image, sam_masks, filterList=self.filterList, stats=filterStats)
+        total_pebbles, average_size, _ = self.calculate_average_size_and_wholeness(pebble_data)
+        cmArea = self.pxAreaToCM2(average_size)
+        
+        imgFile = os.path.basename(image_file)
+        output_image = samProc.makeOutputImage(image, filtered_masks)
+        imageUtils.saveImage(os.path.join(imageAnalyseDir,f"filtered_{imgFile}"), output_image)
+        
+        print(f"{imgFile}: {total_pebbles:03d} pebbles selected, Average Size: {average_size:.2f} pixels, {cmArea:.2f} cm^2")
+        return {"imageFile": imgFile, "pxArea": average_size, "cmArea": cmArea, "filterStats": filterStats}
+
+    def analyseImages(self, samProc, image_list: list, imageAnalyseDir: str, batchSize: int=1, pipelineWorkers: int=0) -> list:
+        """
+        Measure the images in order with an already set up segmenter, returns the sizes without ids.
+        """
         imgFilters = ImageFilters()
         imageUtils = ImageUtilities() 
+        batchSize = max(1, batchSize)
         
-        # apply these filters
-        filterList = ["minimumSize","touchingEdges","occluded", "wholeness", "convexHull", "complexity", "roundish"] #"convexHull",
-        sizes = []        
-        mask_generator = samProc.load_sam()
+        if pipelineWorkers > 0:
+            start = time.perf_counter()
+            pipeline = ImagePipeline(
+                samProc.load_image,
+                lambda loaded: samProc.get_masks_batch([image_rgb for _, image_rgb in loaded]),
+                lambda image_file, loaded, sam_masks: self.measureImage(samProc, imgFilters, imageUtils, image_file,
+                                                                        loaded[0], sam_masks, imageAnalyseDir),
+                batchSize=batchSize, workers=pipelineWorkers)
+            sizes = pipeline.run(image_list)
+            elapsed = time.perf_counter() - start
+            print(f"model busy for {pipeline.inferSeconds:.1f}s, {100 * pipeline.inferSeconds / max(elapsed, 1e-6):.0f}% of the run")
+            return sizes
         
-        id = 1
-        for image_file in image_list:
-            image, image_rgb = samProc.load_image(image_file)        
-            sam_masks = samProc.generate_masks(mask_generator, image_rgb)
+        sizes = []
+        for first in range(0, len(image_list), batchSize):
+            batch_files = image_list[first:first + batchSize]
+            loaded = [samProc.load_image(image_file) for image_file in batch_files]
+            batch_masks = samProc.get_masks_batch([image_rgb for _, image_rgb in loaded])
             
-            filtered_masks, pebble_data = imgFilters.applyfilters(image, sam_masks, filterList=filterList)
-            total_pebbles, average_size, _ = self.calculate_average_size_and_wholeness(pebble_data)
-            cmArea = self.pxAreaToCM2(average_size)
-            
-            imgFile = os.path.basename(image_file)
-            output_image = samProc.makeOutputImage(image, filtered_masks)
-            imageUtils.saveImage(os.path.join(imageAnalyseDir,f"filtered_{imgFile}"), output_image)
-            
-            print(f"{imgFile}: {total_pebbles:03d} pebbles selected, Average Size: {average_size:.2f} pixels, {cmArea:.2f} cm^2")
-            sizes.append({"id": id, "imageFile": imgFile, "pxArea": average_size, "cmArea": cmArea})
-            id=id+1
+            for image_file, (image, _), sam_masks in zip(batch_files, loaded, batch_masks):
+                sizes.append(self.measureImage(samProc, imgFilters, imageUtils, image_file, image, sam_masks, imageAnalyseDir))
+        return sizes
+
+    def shardedSizes(self, samProc, image_list: list, imageAnalyseDir: str, workers: int,
+                     batchSize: int=1, pipelineWorkers: int=0) -> list:
+        """
+        Share the images between worker processes. The model is loaded here first and the
+        workers are forked, so they share its memory copy-on-write instead of each loading
+        their own. It is not loaded when a SAM server is running or every image's masks are
+        in the mask cache, as the workers will not use it. Each worker gets an equal share
+        of the CPU threads. A model on the GPU is not shared, a forked process cannot use
+        its parent's CUDA context, the images are then measured in this process.
+        """
+        global _shardJob
+        
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("--workers needs fork, which is not available here, running in one process")
+            return self.analyseImages(samProc, image_list, imageAnalyseDir, batchSize, pipelineWorkers)
+        
+        # the watershed backend has no model to load
+        usesTorch = isinstance(samProc, SAMprocess)
+        if usesTorch and samProc.mask_generator is None and samProc.needsModel(image_list):
+            samProc.mask_generator = samProc.load_sam()
+        if usesTorch and samProc.device == "cuda":
+            print("--workers is not used with the model on the GPU, running in one process")
+            return self.analyseImages(samProc, image_list, imageAnalyseDir, batchSize, pipelineWorkers)
+        
+        workers = min(workers, len(image_list))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        print(f"{workers} workers, {threads} threads each")
+        _shardJob = {"imgAnalyse": self, "samProc": samProc, "imageAnalyseDir": imageAnalyseDir,
+                     "batchSize": batchSize, "pipelineWorkers": pipelineWorkers}
+        
+        # every workers'th image, so the shards are spread along the beach evenly
+        shards = [list(enumerate(image_list))[w::workers] for w in range(workers)]
+        ctx = multiprocessing.get_context("fork")
+        try:
+            with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_shardInit, initargs=(threads, usesTorch)) as pool:
+                results = list(pool.map(_shardRun, shards))
+        except BrokenProcessPool:
+            # usually a worker killed for running out of memory
+            print("a worker process stopped unexpectedly, try fewer --workers")
+            sys.exit()
+        finally:
+            _shardJob = {}
         
+        sizes = [None] * len(image_list)
+        for w, (shardSizes, seconds) in enumerate(results):
+            print(f"worker {w + 1}: {len(shardSizes)} images in {seconds:.1f}s")
+            for index, entry in shardSizes:
+                sizes[index] = entry
+        return sizes
+
+    def makeAverageSizes(self, image_list: list, imageAnalyseDir: str, batchSize: int=1,
+                         pipelineWorkers: int=0, workers: int=1) -> list:
+        """
+        Filter and measure each image, with a batchSize above 1 the SAM image encoder
+        processes that many images per forward pass. With pipelineWorkers the images are
+        read ahead and filtered and saved on that many threads while the model runs, with
+        workers above 1 the images are shared between that many processes.
+        """
+        samProc = makeSegmenter(self.samSettings) 
+        
+        start = time.perf_counter()
+        if workers > 1 and len(image_list) > 1:
+            sizes = self.shardedSizes(samProc, image_list, imageAnalyseDir, workers, batchSize, pipelineWorkers)
+        else:
+            sizes = self.analyseImages(samProc, image_list, imageAnalyseDir, batchSize, pipelineWorkers)
+        
+        # the image number, so a source that could not be cropped leaves a gap in the plot
+        getFiles = GetFiles()
+        for id, entry in enumerate(sizes, start=1):
+            entry["id"] = getFiles.fileNumber(entry["imageFile"], id)
+        
+        elapsed = time.perf_counter() - start
+        print(f"{len(image_list)} images in {elapsed:.1f}s, {60 * len(image_list) / max(elapsed, 1e-6):.1f} images/minute (batch size {max(1, batchSize)})")
         print(f"Filtered images saved to: {imageAnalyseDir}")
+        self.saveFilterStats(sizes, imageAnalyseDir)
         # cv2.destroyAllWindows()
         return sizes
     
+    def saveFilterStats(self, sizes: list, outDir: str):
+        """
+        Save how many masks each filter took in and rejected, and how long it took, for
+        every image to filter_stats.csv and filter_stats.json, and print the totals.
+        """
+        columns = ["id", "imageFile", "filter", "masksIn", "masksOut", "rejected", "seconds", "cumulativeSeconds"]
+        rows = [dict(stat, id=entry["id"], imageFile=entry["imageFile"])
+                for entry in sizes for stat in entry.get("filterStats", [])]
+        if not rows:
+            return
+        
+        csvFile = os.path.join(outDir, "filter_stats.csv")
+        jsonFile = os.path.join(outDir, "filter_stats.json")
+        try:
+            with open(csvFile, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(rows)
+            with open(jsonFile, "w") as file:
+                file.write(json.dumps([{"id": entry["id"], "imageFile": entry["imageFile"],
+                                        "filters": entry.get("filterStats", [])} for entry in sizes], indent=4))
+        except Exception as e:
+            print(f"Cannot write the filter stats to: {outDir}")
+            print(e)
+            return
+        
+        totals = {}
+        for row in rows:
+            total = totals.setdefault(row["filter"], {"masksIn": 0, "rejected": 0, "seconds": 0.0})
+            for k in total:
+                total[k] += row[k]
+        allSeconds = max(sum(t["seconds"] for t in totals.values()), 1e-9)
+        print(f"{'filter':<18}{'masks in':>10}{'rejected':>10}{'rejected %':>12}{'seconds':>10}{'time %':>8}")
+        for filter, t in totals.items():
+            print(f"{filter:<18}{t['masksIn']:>10}{t['rejected']:>10}{100 * t['rejected'] / max(t['masksIn'], 1):>11.1f}%"
+                  f"{t['seconds']:>10.3f}{100 * t['seconds'] / allSeconds:>7.1f}%")
+        print(f"filter stats saved to: {csvFile} and {jsonFile}")
+        return
+    
     def plotAverageSizes(self, sizes: list, plotOutDir: str):
+        import matplotlib.pyplot as plt
         
         print("Displaying results, press any key while in the plot to exit")
         outPlot = os.path.join(plotOutDir, "avg_sizes_plot.png")
@@ -104,15 +277,15 @@ class ImageAnalyse():
         plt.show()          # or plt.savefig("avg_sizes.png")
         return
     
-    def chugSegment(self, image_file: str, imageID: int, outDir: str):
+    def chugSegment(self, image_file: str, imageID: int, outDir: str, sweeps: list=None, filterList: list=None):
         """ 
-        Used for testing a particular filter, although multiple filters can be tested 
-        here modifying the values one at a time is best. 
+        Used for tuning the filters, the image is filtered with each value (or each
+        combination of values) of the settings being swept, an image is saved for each and
+        the pebble count and average size for all of them are saved to chug_<imageID>.csv.
         
-        testVal is used when testing a particular filter it is in the format:
-        [{"filter": <filerName>, "val": [value,value,value]}, etc...]
-        
-        modifyer values:
+        sweeps are "filter.param=start:stop:step" or "filter.param=v1,v2,..." strings, param
+        is the position in the filter's testVal list:
+            duplicates:     [duplicate_iou: float, nested_inside: float, nested_share: float]
             minimumContours:[min_contours: int]
             minimumSize:    [min_area: int]
             touchingEdges:  [border_buffer: int]
@@ -122,57 +295,59 @@ class ImageAnalyse():
             complexity:     [epsilon_factor: float, min_vertices: int]
             roundish:       [min_roundness: float]       
             
-        the float variables will need to be divided by 100 or a 1000 depending on use
-        see the top of imgFilters.py for default values.   
+        see the top of imgFilters.py for default values, and FilterSweep for how it is run.
         """
         
         imgFilters = ImageFilters()
-        samProc = SAMprocess()    
+        filterSweep = FilterSweep(imgFilters)
+        samProc = makeSegmenter(self.samSettings)    
+        
+        # by default, testing roundish, "minimumSize" and "touchingEdges" work well and
+        # don't need adjustment
+        if not sweeps:
+            sweeps = ["roundish.0=0.30:1.0:0.04"]
+        if not filterList:
+            filterList = ["minimumSize","touchingEdges", "roundish"]
+        sweeps = [filterSweep.parseSweep(s) for s in sweeps]
             
         print(f"One centimeter = {self.oneCentimetre} pixels")
         print(f"processing: {image_file} to {outDir}")
         
         # 1. Initialization (Run SAM only once)
-        mask_generator = samProc.load_sam()
         image, image_rgb = samProc.load_image(image_file)
-        sam_masks = samProc.generate_masks(mask_generator, image_rgb)
-        current_image = image
-            
-        # apply these filters, in this example we are testing roundish
-        # "minimumSize" and "touchingEdges" work well and don't need adjustment
-        filterList = ["minimumSize","touchingEdges", "roundish"]
-            
-        # set a range and step value as integers for the filename
-        for pc in range (30, 100, 4):
-                   
-            # name the filter we are testing, with any value divison needed
-            # testVar can be a list of filters. Those that are not listed use the
-            # default values found at the top of imgFilters.py
-            # the val can be a list of upto three modifyiers depending on the filter.
-            tVal = [pc/100] # [pc/100, None, None]
-            testVal = [{"filter": "roundish", "val": tVal }]
-        
-            filtered_masks, _ = imgFilters.applyfilters(image, sam_masks, filterList=filterList, testVal=testVal)
-                    
-            # Save the visualization
-            output_image = samProc.makeOutputImage(current_image, filtered_masks)
-            outFile = os.path.join(outDir, f"chug_{imageID:03d}_{pc:05d}.png")
-            cv2.imwrite(outFile, output_image)
-            padTval = imgFilters.getTestValues("test", [{"filter": "test", "val": tVal}])
-            print (f"saved: {outFile}, values used: {padTval}")
-        
-        cv2.destroyAllWindows()        
+        sam_masks = samProc.get_masks(image_rgb)
+        
+        start = time.perf_counter()
+        rows = filterSweep.run(image, sam_masks, filterList, sweeps)
+        print(f"{len(rows)} filter settings in {time.perf_counter() - start:.2f}s")
+        
+        columns = ["file"] + [f"{f}.{p}" for f, p, _ in sweeps] + ["pebbles", "average px", "average cm2"]
+        csvRows = []
+        outFiles = []
+        for n, row in enumerate(rows):
+            outFiles.append(os.path.join(outDir, f"chug_{imageID:03d}_{n:05d}.png"))
+            total_pebbles, average_size = self.calculate_average_size(sam_masks.area[row["kept"]].tolist())
+            csvRow = {"file": os.path.basename(outFiles[-1]), "pebbles": total_pebbles,
+                      "average px": f"{average_size:.1f}", "average cm2": f"{self.pxAreaToCM2(average_size):.2f}"}
+            csvRow.update({f"{f}.{p}": v for (f, p), v in row["settings"].items()})
+            csvRows.append(csvRow)
+            print(", ".join(f"{c}: {csvRow[c]}" for c in columns))
+        
+        filterSweep.saveImages(rows, lambda row: samProc.makeOutputImage(image, sam_masks.subset(row["kept"])), outFiles)
+        filterSweep.writeCSV(os.path.join(outDir, f"chug_{imageID:03d}.csv"), csvRows, columns)
         return
     
     def runSegment(self, image_file: str, interactive: bool=False):
         
         imgFilters = ImageFilters()
         imgUtilities = ImageUtilities()
-        samProc = SAMprocess() 
+        samProc = makeSegmenter(self.samSettings) 
         
         ## filters to be used
         # not used: "convexHull"
         filterList = ["minimumSize","touchingEdges","occluded", "wholeness", "complexity", "roundish"]
+        if self.duplicates:
+            filterList.insert(0, "duplicates")
         
         print(f"processing: {image_file}")
         if interactive:
@@ -182,10 +357,9 @@ class ImageAnalyse():
                 print(f"An error occurred: {e}")
         else:        
             try:                        
-                mask_generator = samProc.load_sam()
                 image, image_rgb = samProc.load_image(image_file)
             
-                sam_masks = samProc.generate_masks(mask_generator, image_rgb)
+                sam_masks = samProc.get_masks(image_rgb)
 
                 # Process and filter the masks
                 filtered_masks, pebble_data = imgFilters.applyfilters(image=image, sam_masks=sam_masks, filterList=filterList)
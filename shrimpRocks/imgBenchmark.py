@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import gc
+import csv
+import time
+import numpy as np
+
+from shrimpRocks.samProcess import SAMprocess
+from shrimpRocks.watershedProcess import makeSegmenter
+from shrimpRocks.imgFilters import ImageFilters
+from shrimpRocks.imgAnalyse import ImageAnalyse
+
+
+class ImageBenchmark():
+    """
+    Timing reports used to choose between the different ways of running the analysis,
+    results are printed as a table and returned as a list of dictionaries.
+    """
+
+    def __init__(self, oneCentimetre=75, samSettings=None):
+        self.oneCentimetre = oneCentimetre  # pixels
+        self.samSettings = dict(samSettings or {})
+        return
+
+    def printTable(self, rows: list, columns: list):
+
+        if not rows:
+            print("no results")
+            return
+
+        widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in columns]
+        print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+        print("  ".join("-" * w for w in widths))
+        for r in rows:
+            print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+        return
+
+    def writeCSV(self, filename: str, rows: list, columns: list):
+
+        try:
+            with open(filename, "w", newline="") as csvFile:
+                writer = csv.DictWriter(csvFile, fieldnames=columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(rows)
+        except Exception as e:
+            print(f"Cannot write to file: {filename}")
+            print(e)
+            return
+
+        print(f"report saved to: {filename}")
+        return
+
+    def measureImage(self, samProc, mask_generator, image_file: str) -> dict:
+        """
+        Generate the masks for one image without the cache, filter them as --averagesize
+        does and return the timing and measurements.
+        """
+        imgFilters = ImageFilters()
+        imgAnalyse = ImageAnalyse(self.oneCentimetre)
+
+        image, image_rgb = samProc.load_image(image_file)
+        start = time.perf_counter()
+        sam_masks = samProc.generate_masks(mask_generator, image_rgb)
+        seconds = time.perf_counter() - start
+
+        _, pebble_data = imgFilters.applyfilters(image, sam_masks, filterList=imgAnalyse.filterList)
+        total_pebbles, average_size, _ = imgAnalyse.calculate_average_size_and_wholeness(pebble_data)
+        return {
+            "image": os.path.basename(image_file),
+            "seconds": seconds,
+            "masks": len(sam_masks),
+            "pebbles": total_pebbles,
+            "cmArea": imgAnalyse.pxAreaToCM2(average_size),
+            "sam_masks": sam_masks
+        }
+
+    def matchedMaskIoU(self, masksA, masksB) -> tuple:
+        """
+        Pair the masks generated from the same prompt point and return the fraction of
+        masks paired and their mean IoU.
+        """
+        def pointKey(point):
+            return tuple(round(v, 1) for v in point)
+
+        byPoint = {pointKey(p): j for j, p in enumerate(masksB.point_coords)}
+        ious = []
+        for i, point in enumerate(masksA.point_coords):
+            j = byPoint.get(pointKey(point))
+            if j is None:
+                continue
+            inter, union = masksA.overlap(i, masksB, j)
+            ious.append(inter / union if union else 1.0)
+
+        matched = len(ious) / max(len(masksA), len(masksB), 1)
+        return matched, (float(np.mean(ious)) if ious else 0.0)
+
+    def onnxParity(self, image_list: list, outFile: str=None) -> list:
+        """
+        Compare the ONNX Runtime backend with the torch one on the same images, the masks
+        made from the same prompt point are paired to measure how closely they agree.
+        """
+        settings = dict(self.samSettings, USE_CACHE=False, USE_EMBED_CACHE=False, USE_SERVER=False)
+        torchProc = SAMprocess(dict(settings, RUNTIME="torch"))
+        onnxProc = SAMprocess(dict(settings, RUNTIME="onnx"))
+        torchGenerator = torchProc.load_sam()
+        onnxGenerator = onnxProc.load_sam()
+
+        rows = []
+        for image_file in image_list:
+            t = self.measureImage(torchProc, torchGenerator, image_file)
+            o = self.measureImage(onnxProc, onnxGenerator, image_file)
+            matched, meanIoU = self.matchedMaskIoU(t.pop("sam_masks"), o.pop("sam_masks"))
+            row = {
+                "image": t["image"],
+                "torch s": f"{t['seconds']:.1f}",
+                "onnx s": f"{o['seconds']:.1f}",
+                "torch masks": t["masks"],
+                "onnx masks": o["masks"],
+                "matched": f"{matched:.3f}",
+                "mean IoU": f"{meanIoU:.4f}",
+                "torch pebbles": t["pebbles"],
+                "onnx pebbles": o["pebbles"],
+                "torch cm^2": f"{t['cmArea']:.2f}",
+                "onnx cm^2": f"{o['cmArea']:.2f}"
+            }
+            print(f"  {row['image']}: matched {row['matched']}, mean IoU {row['mean IoU']}, {row['torch cm^2']} / {row['onnx cm^2']} cm^2")
+            rows.append(row)
+
+        columns = ["image", "torch s", "onnx s", "torch masks", "onnx masks", "matched", "mean IoU",
+                   "torch pebbles", "onnx pebbles", "torch cm^2", "onnx cm^2"]
+        self.printTable(rows, columns)
+        if outFile:
+            self.writeCSV(outFile, rows, columns)
+        return rows
+
+    def _variantReport(self, image_list: list, name: str, variants: list, columns: list,
+                       outFile: str=None, shareModel: bool=False) -> list:
+        """
+        Segment the images with each (label, settings override) in variants and compare
+        them with the first one, the baseline. columns are the summary columns shown after
+        name, from s/image, speedup, masks/image, pebbles/image, avg cm^2, mean |diff| cm^2,
+        max |diff| cm^2, mean |diff| %, rank corr and cm^2/image slope. With shareModel the
+        SAM model is loaded once and only the mask generator changes between variants.
+        """
+        settings = dict(self.samSettings, USE_CACHE=False, USE_EMBED_CACHE=False, USE_SERVER=False)
+
+        rows = []
+        sam = None
+        for label, override in variants:
+            samProc = makeSegmenter(dict(settings, **override))
+            if shareModel:
+                if sam is None:
+                    sam = samProc.load_model()
+                mask_generator = samProc.load_sam(sam)
+            else:
+                mask_generator = samProc.load_sam()
+            for image_file in image_list:
+                result = self.measureImage(samProc, mask_generator, image_file)
+                result[name] = label
+                del result["sam_masks"]
+                print(f"  {label} {result['image']}: {result['seconds']:.2f}s, {result['masks']} masks, {result['pebbles']} pebbles, {result['cmArea']:.2f} cm^2")
+                rows.append(result)
+            # only one model in memory at a time
+            del mask_generator, samProc
+            gc.collect()
+
+        labels = [label for label, _ in variants]
+        baseline = np.array([r["cmArea"] for r in rows if r[name] == labels[0]])
+        baseSeconds = sum(r["seconds"] for r in rows if r[name] == labels[0])
+
+        def ranks(values):
+            return np.argsort(np.argsort(values))
+
+        summary = []
+        for label in labels:
+            labelRows = [r for r in rows if r[name] == label]
+            count = max(len(labelRows), 1)
+            cmAreas = np.array([r["cmArea"] for r in labelRows])
+            seconds = sum(r["seconds"] for r in labelRows)
+
+            diff = np.abs(cmAreas - baseline) if len(cmAreas) else np.zeros(1)
+            percent = 100 * diff / np.maximum(baseline, 1e-6) if len(cmAreas) else np.zeros(1)
+            slope = np.polyfit(np.arange(len(cmAreas)), cmAreas, 1)[0] if len(cmAreas) > 1 else 0.0
+            rankCorr = np.corrcoef(ranks(cmAreas), ranks(baseline))[0, 1] if len(cmAreas) > 1 else 1.0
+            summary.append({
+                name: label,
+                "s/image": f"{seconds / count:.2f}",
+                "speedup": f"{baseSeconds / max(seconds, 1e-6):.2f}x",
+                "masks/image": f"{sum(r['masks'] for r in labelRows) / count:.1f}",
+                "pebbles/image": f"{sum(r['pebbles'] for r in labelRows) / count:.1f}",
+                "avg cm^2": f"{cmAreas.mean() if len(cmAreas) else 0:.2f}",
+                "mean |diff| cm^2": f"{diff.mean():.3f}",
+                "max |diff| cm^2": f"{diff.max():.3f}",
+                "mean |diff| %": f"{percent.mean():.2f}",
+                "rank corr": f"{rankCorr:.3f}",
+                "cm^2/image slope": f"{slope:.3f}"
+            })
+
+        perImage = []
+        for image in dict.fromkeys(r["image"] for r in rows):
+            line = {"image": image}
+            for r in rows:
+                if r["image"] == image:
+                    line[f"{r[name]} s"] = f"{r['seconds']:.2f}"
+                    line[f"{r[name]} cm^2"] = f"{r['cmArea']:.2f}"
+            perImage.append(line)
+
+        self.printTable(perImage, ["image"] + [f"{label} {c}" for label in labels for c in ("s", "cm^2")])
+        print()
+        print(f"baseline: {labels[0]}")
+        self.printTable(summary, [name] + columns)
+
+        if outFile:
+            self.writeCSV(outFile, rows, [name, "image", "seconds", "masks", "pebbles", "cmArea"])
+        return rows
+
+    def presetReport(self, image_list: list, presets: list, outFile: str=None) -> list:
+        """
+        Run each mask generator preset over the images, the model is loaded once and shared.
+        Shows the SAM time and the average cm^2 per image for every preset.
+        """
+        variants = [(preset, {"BACKEND": "sam", "PRESET": preset}) for preset in presets]
+        return self._variantReport(image_list, "preset", variants,
+                                   ["s/image", "masks/image", "pebbles/image", "avg cm^2"],
+                                   outFile, shareModel=True)
+
+    def modelComparison(self, image_list: list, modelTypes: list, outFile: str=None) -> list:
+        """
+        Run each SAM backbone over the images and compare it with the first one listed
+        (the baseline, normally vit_h). Besides the time and counts, the correlation of
+        the per-image average cm^2 with the baseline and the slope of cm^2 against the
+        image number show whether the size gradient along the beach is preserved.
+        """
+        variants = [(modelType, {"BACKEND": "sam", "MODEL_TYPE": modelType, "CHECKPOINT": None})
+                    for modelType in modelTypes]
+        return self._variantReport(image_list, "model", variants,
+                                   ["s/image", "speedup", "masks/image", "pebbles/image", "avg cm^2",
+                                    "mean |diff| cm^2", "rank corr", "cm^2/image slope"], outFile)
+
+    def backendReport(self, image_list: list, backends: list, outFile: str=None) -> list:
+        """
+        Segment the images with each backend (sam, watershed) and compare it with the first
+        one listed, the time is the segmentation only and the average cm^2 is after the
+        same filters as --averagesize.
+        """
+        variants = [(backend, {"BACKEND": backend}) for backend in backends]
+        return self._variantReport(image_list, "backend", variants,
+                                   ["s/image", "speedup", "masks/image", "pebbles/image", "avg cm^2",
+                                    "mean |diff| cm^2"], outFile)
+
+    def precisionReport(self, image_list: list, precisions: list, outFile: str=None) -> list:
+        """
+        Run the image encoder at each precision over the images and compare it with the
+        first one listed (normally fp32), the drift is the change in the per-image average
+        pebble size, which is what ends up in the results.
+        """
+        variants = [(precision, {"BACKEND": "sam", "RUNTIME": "torch", "PRECISION": precision})
+                    for precision in precisions]
+        return self._variantReport(image_list, "precision", variants,
+                                   ["s/image", "speedup", "masks/image", "pebbles/image", "avg cm^2",
+                                    "mean |diff| cm^2", "max |diff| cm^2", "mean |diff| %"], outFile)
+
+    def batchThroughput(self, image_list: list, batchSizes: list) -> list:
+        """
+        Time the SAM mask generation over the images for each encoder batch size, the
+        mask cache and server are not used so every image goes through the model.
+        """
+        settings = dict(self.samSettings, USE_CACHE=False, USE_EMBED_CACHE=False, USE_SERVER=False)
+        samProc = SAMprocess(settings)
+        samProc.mask_generator = samProc.load_sam()
+        images_rgb = [samProc.load_image(f)[1] for f in image_list]
+
+        rows = []
+        for batchSize in batchSizes:
+            batchSize = max(1, int(batchSize))
+            start = time.perf_counter()
+            for first in range(0, len(images_rgb), batchSize):
+                samProc.get_masks_batch(images_rgb[first:first + batchSize])
+            elapsed = time.perf_counter() - start
+
+            rows.append({
+                "batch size": batchSize,
+                "images": len(images_rgb),
+                "seconds": f"{elapsed:.1f}",
+                "images/minute": f"{60 * len(images_rgb) / max(elapsed, 1e-6):.2f}"
+            })
+            print(f"batch size {batchSize}: {rows[-1]['images/minute']} images/minute")
+
+        self.printTable(rows, ["batch size", "images", "seconds", "images/minute"])
+        return rows
+
+    def filterTiming(self, image_list: list, outFile: str=None, repeats: int=3) -> list:
+        """
+        Time the --averagesize filters on each image working on full frame masks and on
+        the masks' boxes (the roi option of applyfilters), and check they keep the same
+        pebbles. The masks come from the cache when they are there, only the filters are timed.
+        """
+        samProc = SAMprocess(self.samSettings)
+        imgFilters = ImageFilters()
+        imgAnalyse = ImageAnalyse(self.oneCentimetre)
+
+        def bestTime(image, sam_masks, roi: bool) -> tuple:
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                result = imgFilters.applyfilters(image, sam_masks, filterList=imgAnalyse.filterList, roi=roi)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            return best, result
+
+        rows = []
+        for image_file in image_list:
+            image, image_rgb = samProc.load_image(image_file)
+            sam_masks = samProc.get_masks(image_rgb)
+            fullSeconds, (_, fullData) = bestTime(image, sam_masks, False)
+            roiSeconds, (_, roiData) = bestTime(image, sam_masks, True)
+            rows.append({
+                "image": os.path.basename(image_file),
+                "masks": len(sam_masks),
+                "full frame ms": f"{1000 * fullSeconds:.1f}",
+                "roi ms": f"{1000 * roiSeconds:.1f}",
+                "speedup": f"{fullSeconds / max(roiSeconds, 1e-9):.1f}x",
+                "same": fullData == roiData
+            })
+            print(f"  {rows[-1]['image']}: full frame {rows[-1]['full frame ms']}ms, roi {rows[-1]['roi ms']}ms")
+
+        columns = ["image", "masks", "full frame ms", "roi ms", "speedup", "same"]
+        self.printTable(rows, columns)
+        if outFile:
+            self.writeCSV(outFile, rows, columns)
+        return rows
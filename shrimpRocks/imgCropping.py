@@ -6,13 +6,18 @@ import numpy as np
 import math
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from shrimpRocks.imgUtilities import ImageUtilities
 
 class ImageCropping():
     
-    def __init__(self, testDir="images/"):
+    def __init__(self, testDir="images/", rulerDetector: str="hough"):
         self.testDir = testDir
+        ## how the inside edges of the ruler are found, hough: detectTopAndLeftInsideEdges,
+        # profile: detectProfileEdges, with the Hough lines when it is not confident
+        self.rulerDetector = rulerDetector
         ## allowance angle for the horzontal and vertical lines that are in the images
         self.angleTolerance = 12 
         ## minimum distance in pixels between the left/top inside edge of the ruler 
@@ -32,6 +37,21 @@ class ImageCropping():
         self.minLineLength=400
         self.maxLineGap=5
         
+        ## used by detectProfileEdges, the yellow of the ruler in OpenCV HSV (hue 0 to 180)
+        self.rulerLower = (15, 80, 80)
+        self.rulerUpper = (40, 255, 255)
+        # the image is searched at 1/profileScale size, then the edge is found at full size
+        # within refineBand pixels of it
+        self.profileScale = 4
+        self.refineBand = 8
+        # the fraction of a row or column that must be yellow for it to be part of a ruler
+        self.profileThreshold = 0.4
+        # the profile edges are only used when the ruler band is at least minRulerWidth
+        # pixels wide and, on average, this fraction yellow, and drops to under half the
+        # profileThreshold within 2 pixels of the edge, otherwise the Hough lines are used
+        self.profileConfidence = 0.6
+        self.minRulerWidth = 20
+        
         return
     
     def selectInsideYellowSquare(self, imagePath: str, testMode: bool=False) -> tuple:
@@ -53,9 +73,9 @@ class ImageCropping():
         image = image[:, 0:1980]
        
         # find the inner top and left of the square marked out by the ruler
-        x, y, testimg = self.detectTopAndLeftInsideEdges(image)        
+        x, y, testimg = self.detectRulerEdges(image)        
         if x is None or y is None:
-            return None
+            return None, testimg
         
         # crop the left and top plus some padding
         image = image[y+self.cropPadding:, x+self.cropPadding:]
@@ -65,6 +85,180 @@ class ImageCropping():
                                                                                 
         return image, testimg
     
+    def compareDetectors(self, imagePaths: list) -> list:
+        """
+        The ruler edges and time per frame from the projection profiles and from the Hough
+        lines, to check they agree and see the difference in speed.
+        """
+        rows = []
+        for imagePath in imagePaths:
+            image = cv2.imread(imagePath)
+            if image is None:
+                print(f"CV2 Cannot load image: {imagePath}")
+                continue
+            image = image[:, 0:1980]
+            start = time.perf_counter()
+            profile = self.detectProfileEdges(image)
+            profileSeconds = time.perf_counter() - start
+            start = time.perf_counter()
+            hough = self.detectTopAndLeftInsideEdges(image)[:2]
+            houghSeconds = time.perf_counter() - start
+            
+            hough = tuple(None if v is None else int(v) for v in hough)
+            rows.append({"image": os.path.basename(imagePath), "profile": profile, "hough": hough,
+                         "profileSeconds": profileSeconds, "houghSeconds": houghSeconds})
+            print(f"{rows[-1]['image']}: profile x, y {profile} in {1000 * profileSeconds:.0f}ms, "
+                  f"hough x, y {hough} in {1000 * houghSeconds:.0f}ms{'' if profile == hough else ', differ'}")
+        
+        if rows:
+            same = sum(r["profile"] == r["hough"] for r in rows)
+            profileSeconds = sum(r["profileSeconds"] for r in rows) / len(rows)
+            houghSeconds = sum(r["houghSeconds"] for r in rows) / len(rows)
+            print(f"{same} of {len(rows)} frames the same, profile {1000 * profileSeconds:.0f}ms, "
+                  f"hough {1000 * houghSeconds:.0f}ms per frame")
+        return rows
+    
+    def encodeCrop(self, imagePath: str) -> tuple:
+        """
+        Crop one source image and encode it as PNG, returns (png bytes, None) or
+        (None, the reason) so one bad frame does not stop the others.
+        """
+        try:
+            image = cv2.imread(imagePath)
+            if image is None:
+                return None, "cannot load the image"
+            image, _ = self.selectInsideYellowSquareImage(image)
+            if image is None:
+                return None, "the ruler edges were not found"
+            ok, png = cv2.imencode(".png", image)
+            if not ok:
+                return None, "cannot encode the image"
+        except Exception as e:
+            return None, str(e)
+        return png.tobytes(), None
+    
+    def cropImages(self, imagePaths: list, outDir: str, workers: int=1) -> int:
+        """
+        Crop the source images to rocks_NN.png in outDir, NN is the position of the source
+        in imagePaths. With workers above 1 the frames are read, cropped and encoded on that
+        many processes, the files are written here in order. A frame that cannot be cropped
+        is reported and its number left unused, returns the number of images written.
+        """
+        if workers > 1 and len(imagePaths) > 1:
+            # each process gets one OpenCV thread, the processes are the parallelism
+            with ProcessPoolExecutor(min(workers, len(imagePaths)), initializer=cv2.setNumThreads, initargs=(1,)) as pool:
+                results = pool.map(self.encodeCrop, imagePaths)
+                written = self.writeCrops(imagePaths, results, outDir)
+        else:
+            written = self.writeCrops(imagePaths, map(self.encodeCrop, imagePaths), outDir)
+        
+        failed = len(imagePaths) - written
+        if failed:
+            print(f"{failed} of {len(imagePaths)} source images could not be cropped")
+        return written
+    
+    def writeCrops(self, imagePaths: list, results, outDir: str) -> int:
+        
+        written = 0
+        for c, (imagePath, (png, error)) in enumerate(zip(imagePaths, results), 1):
+            if png is None:
+                print(f"cannot crop: {imagePath}, {error}, rocks_{str(c).zfill(2)}.png is left out")
+                continue
+            filename = os.path.join(outDir, f"rocks_{str(c).zfill(2)}.png")
+            try:
+                with open(filename, "wb") as pngFile:
+                    pngFile.write(png)
+            except Exception as e:
+                print(f"Cannot save image: {filename}")
+                print(e)
+                continue
+            print(f"{os.path.basename(imagePath)} -> {os.path.basename(filename)}")
+            written += 1
+        return written
+    
+    def detectRulerEdges(self, image: list) -> tuple:
+        """
+        The inside top and left edges of the ruler from the Hough lines of
+        detectTopAndLeftInsideEdges or, with rulerDetector profile, from detectProfileEdges
+        unless those edges are not clear.
+        """
+        if self.rulerDetector != "profile":
+            return self.detectTopAndLeftInsideEdges(image)
+        
+        x, y = self.detectProfileEdges(image)
+        if x is None or y is None:
+            print("the ruler edges are not clear in the profiles, using the Hough lines")
+            return self.detectTopAndLeftInsideEdges(image)
+        
+        testImg = image.copy()
+        height, width = image.shape[:2]
+        cv2.line(testImg, (x, 0), (x, height - 1), (0, 0, 255), 2)
+        cv2.line(testImg, (0, y), (width - 1, y), (0, 255, 0), 2)
+        return x, y, testImg
+    
+    def rulerMask(self, image: list) -> np.ndarray:
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        return cv2.inRange(hsv, self.rulerLower, self.rulerUpper)
+    
+    def profileEdge(self, profile: np.ndarray, scale: int) -> int:
+        """
+        The inside edge of a ruler from the fraction of yellow in each column (or row) of the
+        downscaled image: the last position of the first yellow band whose next band is more
+        than minDistance pixels away, as detectTopAndLeftInsideEdges does with the lines.
+        None when there is no such band, or it is too narrow or too faint to be the ruler.
+        """
+        on = np.concatenate(([0], (profile >= self.profileThreshold).astype(np.int8), [0]))
+        changes = np.diff(on)
+        starts = np.flatnonzero(changes == 1)
+        ends = np.flatnonzero(changes == -1) - 1
+        for i in range(len(starts) - 1):
+            if (starts[i + 1] - ends[i]) * scale > self.minDistance:
+                width = (ends[i] - starts[i] + 1) * scale
+                if width < self.minRulerWidth or profile[starts[i]:ends[i] + 1].mean() < self.profileConfidence:
+                    return None
+                return int(ends[i])
+        return None
+    
+    def refineEdge(self, strip: np.ndarray, coarse: int) -> int:
+        """
+        The last yellow column of a full size strip of the ruler mask, whose columns start
+        at full size position coarse - refineBand. None unless the yellow stops sharply there.
+        """
+        profile = np.count_nonzero(strip, axis=0) / max(strip.shape[0], 1)
+        on = np.flatnonzero(profile >= self.profileThreshold)
+        if len(on) == 0:
+            return None
+        edge = int(on[-1])
+        after = profile[edge + 1:edge + 3]
+        if profile[edge] < self.profileConfidence or len(after) < 2 or after[1] > self.profileThreshold / 2:
+            return None
+        return max(coarse - self.refineBand, 0) + edge
+    
+    def detectProfileEdges(self, image: list) -> tuple:
+        """
+        Find the inside top and left edges of the ruler from how much of each row and column
+        is ruler yellow. The profiles are taken from a downscaled image and each edge is
+        then placed to the pixel in a narrow band of the full size image. Returns
+        (None, None) when either edge is not clear, see profileConfidence.
+        """
+        scale = self.profileScale
+        small = cv2.resize(image, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA)
+        mask = self.rulerMask(small)
+        xCoarse = self.profileEdge(np.count_nonzero(mask, axis=0) / mask.shape[0], scale)
+        yCoarse = self.profileEdge(np.count_nonzero(mask, axis=1) / mask.shape[1], scale)
+        if xCoarse is None or yCoarse is None:
+            return None, None
+        
+        # the last full size pixel inside the coarse position, give or take the band
+        xCoarse = xCoarse * scale + scale - 1
+        yCoarse = yCoarse * scale + scale - 1
+        band = self.refineBand
+        x = self.refineEdge(self.rulerMask(image[:, max(xCoarse - band, 0):xCoarse + band + 1]), xCoarse)
+        y = self.refineEdge(self.rulerMask(image[max(yCoarse - band, 0):yCoarse + band + 1, :]).T, yCoarse)
+        if x is None or y is None:
+            return None, None
+        return x, y
+    
     def detectTopAndLeftInsideEdges(self, image: list) -> tuple:
         
         testImg = image.copy()
@@ -82,8 +276,10 @@ class ImageCropping():
         # Find the positions of the mostly horizontal and vertical lines
         verticalLines = []
         horizontalLines = []
+        # OpenCV 4 gives the lines as (N, 1, 4) and OpenCV 5 as (N, 4)
+        lines = np.zeros((0, 4), dtype=np.int32) if lines is None else lines.reshape(-1, 4)
         for line in lines:
-            x1, y1, x2, y2 = line[0]
+            x1, y1, x2, y2 = line
             if self.isMostlyVertical(x1, y1, x2, y2):
                 x_avg = (x1 + x2) // 2                
                 cv2.line(testImg,(x1,y1),(x2,y2),(0,0,255),2)                
@@ -96,11 +292,11 @@ class ImageCropping():
 
         if len(verticalLines) == 0:
             print ("no vertical lines found")
-            return [None, None]
+            return None, None, testImg
         
         if len(horizontalLines) == 0:
             print ("no horizontal lines found")
-            return [None, None]        
+            return None, None, testImg        
         
         # Sort lines by their coordinates
         verticalLines = sorted(verticalLines) 
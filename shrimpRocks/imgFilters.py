@@ -1,6 +1,10 @@
 import cv2
+import time
 import numpy as np
 
+from shrimpRocks.maskSet import MaskSet
+from shrimpRocks.occlusionMap import OcclusionMap
+
 
 class ImageFilters():
     """ 
@@ -14,8 +18,12 @@ class ImageFilters():
             "MIN_CONTOURS": 85,             # contourCheck
             "MIN_AREA": 3000,               # minimumSizeFiler,  Minimum area for a contour to be considered valid
             "BORDER_BUFFER": 5,             # touchingEdges
+            "DUPLICATE_IOU": 0.9,           # suppressMasks, masks overlapping this much are the same pebble
+            "NESTED_INSIDE": 0.95,          # suppressMasks, share of a mask inside a larger one for it to count as nested
+            "NESTED_SHARE": 0.15,           # suppressMasks, how much of the larger mask the nested one must cover
             "IOU_THRESH": 0.5,              # occlusionMask
             "OVERLAP_SELF_THRESH": 0.15,    # occlusionMask
+            "PACKED_OCCLUSION": False,      # occlusionPass, count the overlaps on bit packed rows, see OcclusionMap
             "MIN_SOLIDITY": 0.15,           # wholenessScore
             "MAX_DEFECT_RATIO": 54 / 1000,  # convexShapeFilter, 0.054% threshold for the defect ratio
             "EPSILON_FACTOR": 0.02,         # complexShapeFilter, 
@@ -24,6 +32,37 @@ class ImageFilters():
             "MAX_HULL_DIFF_RATIO": 0.030,   # convexHullDifference
             "MIN_ROUNDNESS": 0.35           # is_roundish
         }    
+        
+        ## the stages applyfilters can run, what each needs and a rough relative cost per mask.
+        # metadata: SAM's area and the mask's box, pixels: the mask itself, features: the
+        # maskFeatures table, which is itself the "features" stage. The stages listed before
+        # "occluded" decide which masks it sees and the rest only look at those it keeps, so
+        # each stays on its own side of it, on each side the cheapest run first.
+        #   enabledBy: runs when that filter is in the filterList
+        self.filterStages = {
+            "duplicates":       {"needs": "pixels", "cost": 5},     # compares all the masks, whatever else is on
+            "features":         {"needs": "pixels", "cost": 20},
+            "minimumContours":  {"needs": "features", "cost": 1},
+            "minimumSize":      {"needs": "metadata", "cost": 1},
+            "minimumPerimeter": {"needs": "features", "cost": 1, "enabledBy": "minimumSize"},
+            "touchingEdges":    {"needs": "metadata", "cost": 1},
+            "occluded":         {"needs": "pixels", "cost": 10},
+            "wholeness":        {"needs": "features", "cost": 1},
+            "convexHull":       {"needs": "features", "cost": 1},
+            "complexity":       {"needs": "features", "cost": 1},
+            "roundish":         {"needs": "features", "cost": 1}
+        }
+        ## the order applyfilters runs them in
+        self.stages = self.stageOrder()
+        
+        ## the columns of maskFeatures
+        self.featureDtype = np.dtype([
+            ("x", np.int32), ("y", np.int32), ("w", np.int32), ("h", np.int32),
+            ("area", np.int64),
+            ("contourPoints", np.int32), ("contourArea", np.float64), ("perimeter", np.float64),
+            ("hullPoints", np.int32), ("hullArea", np.float64), ("hullPerimeter", np.float64),
+            ("solidity", np.float64), ("roundness", np.float64), ("vertices", np.int32)
+        ])
      
     def minimumContourFilter(self, contours, min_contours: int=None) -> list[np.int32]:
         """
@@ -59,22 +98,74 @@ class ImageFilters():
         # print(f"min_area: {min_area},  Area: {area}, Perimeter: {perimeter}, {(self.MIN_AREA < area and perimeter > 0)}")   
         return (min_area < area and perimeter > 0)        
     
-    def touchingEdges(self, mask, height: int, width: int,  border_buffer: int=None) -> bool:
+    def touchingEdges(self, bbox, height: int, width: int,  border_buffer: int=None) -> bool:
         """
-        Checks if the mask touches the edges of the image within a specified buffer.
+        Checks if the mask touches the edges of the image within a specified buffer,
+        bbox is the mask's x, y, w, h as given by cv2.boundingRect.
         """
         if border_buffer is None:
             border_buffer = self.defaults['BORDER_BUFFER']
         
-        x, y, w, h = cv2.boundingRect(mask)
+        x, y, w, h = bbox
         touches_edge = (x < border_buffer or y < border_buffer or 
                         (x + w) > (width - border_buffer) or 
                         (y + h) > (height - border_buffer))
         return touches_edge
     
-    def occlusionMask(self, mask, exclusion_mask, iou_thresh: float=None, overlap_self_thresh: float=None) -> tuple:
+    def suppressMasks(self, sam_masks: MaskSet, duplicate_iou: float=None, nested_inside: float=None,
+                      nested_share: float=None, min_area: int=None, indices=None) -> list:
+        """
+        Remove SAM's repeated masks, returns the indices kept. Only the masks in indices,
+        those still in after the filters before it, are compared, so a mask already
+        rejected cannot take a good one with it. Of two near identical masks the one SAM
+        scored lower goes. A mask holding a smaller one that covers a fair share of it
+        goes, but the nested mask must be at least the minimum size to count. It is not
+        the same choice the occlusion filter makes, the nested mask may itself fail a later
+        filter, so it is only run when asked for. The masks are compared only where their
+        boxes meet, and the pixels only when the areas and boxes leave the test undecided.
+        """
+        if indices is None:
+            indices = range(len(sam_masks))
+        if duplicate_iou is None:
+            duplicate_iou = self.defaults['DUPLICATE_IOU']
+        if nested_inside is None:
+            nested_inside = self.defaults['NESTED_INSIDE']
+        if nested_share is None:
+            nested_share = self.defaults['NESTED_SHARE']
+        if min_area is None:
+            min_area = self.defaults['MIN_AREA']
+        
+        dropped = set()
+        for i, j in sam_masks.boxPairs(indices=indices):
+            if i in dropped or j in dropped:
+                continue
+            small, large = (i, j) if sam_masks.area[i] <= sam_masks.area[j] else (j, i)
+            areaSmall, areaLarge = int(sam_masks.area[small]), int(sam_masks.area[large])
+            boxInter = sam_masks.boxIntersection(i, j)
+            
+            # the IoU can be no more than the ratio of the areas, and the nested share
+            # of the small mask no more than the overlap of the boxes
+            maybeDuplicate = areaSmall >= duplicate_iou * areaLarge and boxInter >= duplicate_iou * areaLarge
+            maybeNested = (areaSmall >= min_area and areaSmall >= nested_share * areaLarge and
+                           boxInter >= nested_inside * areaSmall)
+            if not (maybeDuplicate or maybeNested):
+                continue
+            
+            inter, union = sam_masks.overlap(i, sam_masks, j)
+            if maybeDuplicate and inter >= duplicate_iou * union:
+                worse = i if sam_masks.predicted_iou[i] < sam_masks.predicted_iou[j] else j
+                dropped.add(worse)
+            elif maybeNested and inter >= nested_inside * areaSmall:
+                dropped.add(large)
+        
+        return [int(i) for i in sorted(indices) if i not in dropped]
+
+    def occlusionMask(self, mask, exclusion_mask, iou_thresh: float=None, overlap_self_thresh: float=None,
+                      exclusion_area: int=None) -> tuple:
         """ 
-        decides if a candidate pebble mask overlaps too much with ones already accepted
+        decides if a candidate pebble mask overlaps too much with ones already accepted,
+        the masks can be the same window of the image, in which case exclusion_area is the
+        pixel count of the whole exclusion mask.
         """
         if iou_thresh is None:
             iou_thresh = self.defaults['IOU_THRESH']
@@ -91,7 +182,7 @@ class ImageFilters():
             return False, cv2.bitwise_or(exclusion_mask, mask)
 
         area_cur = cur.sum()
-        area_prev = prev.sum()
+        area_prev = prev.sum() if exclusion_area is None else exclusion_area
         union = area_cur + area_prev - inter
 
         iou = inter / (union + 1e-6)
@@ -222,7 +313,9 @@ class ImageFilters():
         
     def is_roundish(self, mask_bool, min_roundness: float=None) -> bool:
         """
-        See how round the selected pebble is, to filter out irregular shapes
+        See how round the selected pebble is, to filter out irregular shapes. The mask can
+        be the full frame or the mask's box with a one pixel border (MaskSet.paddedCrop),
+        the roundness does not depend on where it is.
         """        
         # Roundness = 4πA / P² -> ~1 for perfect circle, smaller for irregular
         if min_roundness is None:
@@ -265,19 +358,238 @@ class ImageFilters():
         return (outVal + pad * [None])[:pad]
     
     
+    def largestContour(self, sam_masks: MaskSet, i: int, roi: bool=True):
+        """
+        The mask's largest external contour in image coordinates, None when it has none.
+        """
+        if roi:
+            contours = sam_masks.contours(i)
+        else:
+            full = sam_masks.full(i).view(np.uint8) * 255
+            contours, _ = cv2.findContours(full, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(contours) == 0:
+            return None
+        return max(contours, key=cv2.contourArea)
+
+    def maskFeatures(self, sam_masks: MaskSet, indices=None, epsilon_factor: float=None, roi: bool=True) -> np.ndarray:
+        """
+        Measure each mask once, returns a structured array with a row per mask in sam_masks
+        (rows not in indices are left at zero). The filters are then comparisons over its
+        columns, see featureFilter.
+            x, y, w, h:         the mask's box
+            area:               SAM's pixel count
+            contourPoints:      points in the largest contour, 0 when there is no contour
+            contourArea, perimeter:      of the largest contour
+            hullPoints, hullArea, hullPerimeter: of its convex hull
+            solidity:           area / hullArea, 0 without a usable hull
+            roundness:          4πA / P² of the contour
+            vertices:           after cv2.approxPolyDP with epsilon_factor of the perimeter
+        """
+        if epsilon_factor is None:
+            epsilon_factor = self.defaults['EPSILON_FACTOR']
+        if indices is None:
+            indices = range(len(sam_masks))
+        
+        features = np.zeros(len(sam_masks), dtype=self.featureDtype)
+        if len(sam_masks):
+            features["x"], features["y"], features["w"], features["h"] = sam_masks.boxes.T
+            features["area"] = sam_masks.area
+        
+        for i in indices:
+            contour = self.largestContour(sam_masks, i, roi)
+            if contour is None:
+                continue
+            
+            row = features[i]
+            perimeter = cv2.arcLength(contour, True)
+            contour_area = cv2.contourArea(contour)
+            hull_points = cv2.convexHull(contour, returnPoints=True)
+            row["contourPoints"] = len(contour)
+            row["contourArea"] = contour_area
+            row["perimeter"] = perimeter
+            row["hullPoints"] = len(hull_points)
+            row["vertices"] = len(cv2.approxPolyDP(contour, epsilon_factor * perimeter, True))
+            if perimeter > 0 and contour_area > 0:
+                row["roundness"] = 4 * np.pi * contour_area / (perimeter * perimeter)
+            if len(hull_points) >= 3:
+                row["hullArea"] = cv2.contourArea(hull_points)
+                row["hullPerimeter"] = cv2.arcLength(hull_points, True)
+                if row["hullArea"] > 0:
+                    row["solidity"] = row["area"] / row["hullArea"]
+        return features
+
+    def featureFilter(self, features: np.ndarray, filter: str, values: list, height: int, width: int) -> np.ndarray:
+        """
+        The masks that pass one filter as a boolean array, worked out from the maskFeatures
+        columns the same way the single mask filters above work on a contour. values are the
+        getTestValues for the filter, None for the defaults.
+        """
+        a, b, _ = values
+        hasHull = (features["hullPoints"] >= 3) & (features["hullArea"] > 0)
+        
+        if filter == "minimumContours":
+            min_contours = self.defaults['MIN_CONTOURS'] if a is None else a
+            return (features["contourPoints"] > 0) & (features["contourPoints"] >= min_contours)
+        
+        if filter == "minimumSize":
+            min_area = self.defaults['MIN_AREA'] if a is None else a
+            return (features["area"] > min_area) & (features["perimeter"] > 0)
+        
+        # the part of minimumSize that needs the contour
+        if filter == "minimumPerimeter":
+            return features["perimeter"] > 0
+        
+        if filter == "touchingEdges":
+            border_buffer = self.defaults['BORDER_BUFFER'] if a is None else a
+            x, y, w, h = features["x"], features["y"], features["w"], features["h"]
+            return ~((x < border_buffer) | (y < border_buffer) |
+                     ((x + w) > (width - border_buffer)) | ((y + h) > (height - border_buffer)))
+        
+        if filter == "wholeness":
+            minSolidity = self.defaults['MIN_SOLIDITY'] if a is None else a
+            return hasHull & (features["solidity"] >= minSolidity)
+        
+        if filter == "convexHull":
+            maxHullDiffRatio = self.defaults['MAX_HULL_DIFF_RATIO'] if b is None else b
+            hull_defect_area = np.maximum(features["hullArea"] - features["contourArea"], 0.0)
+            return (features["hullPoints"] >= 3) & (hull_defect_area / (features["hullArea"] + 1e-6) <= maxHullDiffRatio)
+        
+        if filter == "complexity":
+            min_vertices = self.defaults['MIN_VERTICES'] if b is None else b
+            return features["vertices"] > min_vertices
+        
+        if filter == "roundish":
+            min_roundness = self.defaults['MIN_ROUNDNESS'] if a is None else a
+            return features["roundness"] > min_roundness
+        
+        raise ValueError(f"not a per-mask filter: {filter}")
+
+    def occlusionPass(self, sam_masks: MaskSet, indices, iou_thresh: float=None, overlap_self_thresh: float=None,
+                      roi: bool=True) -> np.ndarray:
+        """
+        Run the occlusion test over the masks in the given order, each one is compared with
+        the masks accepted before it. Returns a boolean array, True for the masks occluded.
+        """
+        if iou_thresh is None:
+            iou_thresh = self.defaults['IOU_THRESH']
+        if overlap_self_thresh is None:
+            overlap_self_thresh = self.defaults['OVERLAP_SELF_THRESH']
+        
+        occluded = np.zeros(len(sam_masks), dtype=bool)
+        if roi:
+            # only the part of the map inside each mask's box is looked at
+            occlusionMap = OcclusionMap(sam_masks.shape, self.defaults['PACKED_OCCLUSION'])
+            for i in indices:
+                occluded[i] = occlusionMap.check(sam_masks, i, iou_thresh, overlap_self_thresh)["occluded"]
+            return occluded
+        
+        exclusion_mask = np.zeros(sam_masks.shape, dtype=np.uint8)
+        for i in indices:
+            full = sam_masks.full(i).view(np.uint8) * 255
+            occluded[i], exclusion_mask = self.occlusionMask(full, exclusion_mask, iou_thresh, overlap_self_thresh)
+        return occluded
+    
     # available filers:
     # filterList = ["minimumSize","touchingEdges","occluded", "wholeness",
     #               "convexHull", "conplexity", "roundish"]
     # the optional testVal
-    def applyfilters(self, image: list[np.ndarray], sam_masks: list, filterList: list, testVal: list = []) -> tuple:
+    def stageOrder(self) -> list:
+        """
+        The filterStages in the order to run them, those that only need the metadata
+        first, then those that need the mask pixels (the feature table is made there),
+        then those that need the feature table, by cost within each.
+        """
+        needs = {"metadata": 0, "pixels": 1, "features": 2}
+        names = list(self.filterStages)
+        split = names.index("occluded")
+        
+        def ordered(stages):
+            return sorted(stages, key=lambda s: (needs[self.filterStages[s]["needs"]], self.filterStages[s]["cost"]))
+        return ordered(names[:split]) + ["occluded"] + ordered(names[split + 1:])
+
+    def stageEnabled(self, stage: str, filterList: list) -> bool:
+        
+        if stage in ("features", "minimumContours") or stage in filterList:
+            return True
+        return self.filterStages[stage].get("enabledBy") in filterList
+
+    def stageValues(self, stage: str, testVal: list) -> list:
+        """
+        The stage's getTestValues, features takes the complexity epsilon_factor.
+        """
+        if stage == "features":
+            return self.getTestValues("complexity", testVal)[:1]
+        if stage == "minimumPerimeter":
+            return [None, None, None]
+        return self.getTestValues(stage, testVal)
+
+    def metadataFilter(self, sam_masks: MaskSet, stage: str, values: list, height: int, width: int) -> np.ndarray:
+        """
+        The filters that only need SAM's area or the mask's box, before any contour is found.
         """
-        Apply the filters, available filters:
+        if stage == "minimumSize":
+            min_area = self.defaults['MIN_AREA'] if values[0] is None else values[0]
+            return sam_masks.area > min_area
+        
+        if stage == "touchingEdges":
+            border_buffer = self.defaults['BORDER_BUFFER'] if values[0] is None else values[0]
+            x, y, w, h = sam_masks.boxes.T
+            return ~((x < border_buffer) | (y < border_buffer) |
+                     ((x + w) > (width - border_buffer)) | ((y + h) > (height - border_buffer)))
+        
+        raise ValueError(f"not a metadata filter: {stage}")
+
+    def filterStage(self, stage: str, sam_masks: MaskSet, features: np.ndarray, indices, values: list,
+                    height: int, width: int, roi: bool=True) -> np.ndarray:
+        """
+        One stage of applyfilters, returns a boolean array of the masks that pass it.
+        indices are the masks still in, smallest first.
+        """
+        if stage == "duplicates":
+            duplicate_iou, nested_inside, nested_share = values
+            passed = np.zeros(len(sam_masks), dtype=bool)
+            passed[self.suppressMasks(sam_masks, duplicate_iou, nested_inside, nested_share, indices=indices)] = True
+            return passed
+        
+        # the one filter that depends on the others, a mask is compared with the smaller
+        # ones that passed the filters before it
+        if stage == "occluded":
+            iou_thresh, overlap_self_thresh, _ = values
+            return ~self.occlusionPass(sam_masks, indices, iou_thresh, overlap_self_thresh, roi)
+        
+        if self.filterStages[stage]["needs"] == "metadata":
+            return self.metadataFilter(sam_masks, stage, values, height, width)
+        
+        return self.featureFilter(features, stage, values, height, width)
+
+    def applyfilters(self, image: list[np.ndarray], sam_masks: MaskSet, filterList: list, testVal: list = [],
+                     roi: bool=True, memo: dict=None, stats: list=None) -> tuple:
+        """
+        Apply the filters to a MaskSet (a list of SAM mask dictionaries is converted first),
+        returns the MaskSet of the masks kept and their (area, solidity). Available filters:
         ["minimumSize", "touchingEdges", "occluded", "wholeness", "convexHull", "complexity", "roundish"]
+        and "duplicates", which can change the result so is only used when asked for (see suppressMasks).
+        The filters run in the order of self.stages (see self.filterStages), the checks that
+        only need each mask's area or box run before any contours are found, so the masks
+        they reject are never measured. The masks kept are the same in any order.
+        
+        With roi each mask is worked on inside its own box, the contours are offset back to
+        image coordinates. roi=False works on full frame masks instead, it gives the same
+        result and is only kept to measure the difference, see ImageBenchmark.filterTiming.
+        
+        memo, when given, keeps the result of each stage between calls for the same masks
+        and image, so when only a later filter or its value changes the stages before it
+        are not run again. Use a new dictionary for each MaskSet.
+        
+        stats, when given a list, gets a row per stage that is switched on:
+        {"filter", "masksIn", "masksOut", "rejected", "seconds", "cumulativeSeconds"},
+        a stage taken from the memo shows 0 seconds.
         
         Optional: testVal is used when testing a particular filter it is in the format:
         [{"filter": <filerName>, "val": [value,value,value]}, etc...]
         
         modifyer values:
+            duplicates:      [duplicate_iou: float, nested_inside: float, nested_share: float]
             minimumContours: [min_contours: int]
             minimumSize:     [min_area: int]
             touchingEdges:   [border_buffer: int]
@@ -288,75 +600,61 @@ class ImageFilters():
             roundish:        [min_roundness: float]            
         """
     
-        filtered_masks = []
-        pebble_data = [] 
-        
-        height, width = image.shape[:2]
-        exclusion_mask = np.zeros(image.shape[:2], dtype=np.uint8)
-
-        # Sort masks by area (smallest first)
-        sorted_masks = sorted(sam_masks, key=lambda x: x['area'], reverse=False)
-        
-        for mask_data in sorted_masks:
-            mask = mask_data['segmentation'].astype(np.uint8) * 255
-            area = mask_data['area']
-        
-            # Contour Extraction
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if len(contours) == 0:
-               continue
-      
-            min_contours, _, _ = self.getTestValues("minimumContours", testVal)
-            contour = self.minimumContourFilter(contours, min_contours)
-            if contour is None:
-                continue
-            
-            if "minimumSize" in filterList:
-                min_area, _, _ = self.getTestValues("minimumSize", testVal)
-                if not self.minimumSizeFilter(contour, area, min_area):
-                    continue
-        
-            # Edge Proximity Check
-            if "touchingEdges" in filterList: 
-                border_buffer, _, _ = self.getTestValues("touchingEdges", testVal)           
-                if self.touchingEdges(mask, height, width, border_buffer):
-                    continue
-                    
-            if "occluded" in filterList:
-                iou_thresh, overlap_self_thresh, _ = self.getTestValues("occluded", testVal)
-                occluded, exclusion_mask = self.occlusionMask(mask, exclusion_mask, iou_thresh, overlap_self_thresh)
-                if occluded:
-                    continue
-                    
-            _ , solidity = self.wholenessScore(contour, area)
-            # Wholeness Score (Solidity) Check
-            if "wholeness" in filterList:
-                minSolidity, _, _ = self.getTestValues("wholeness", testVal)
-                wholeness, _ = self.wholenessScore(contour, area, minSolidity)
-                if not wholeness:
-                    continue     
-              
-            # this filters out too many large pebbles  
-            if "convexHull" in filterList:
-                convexHullDiff, maxHullDiffRatio, _ = self.getTestValues("convexHull", testVal)
-                if not self.convexHullDifference(contour, convexHullDiff, maxHullDiffRatio):
-                    continue
-                
-            if "complexity" in filterList:
-                epsilon_factor, min_vertices, _ = self.getTestValues("complexity", testVal)
-                if not self.complexShapeFilter(contour, epsilon_factor, min_vertices):
-                    continue
-                
-            if "roundish" in filterList:
-                min_roundness, _, _ = self.getTestValues("roundish", testVal)
-                if not self.is_roundish(mask, min_roundness):
-                    continue
-                
-            filtered_masks.append(mask_data)
-            pebble_data.append((area, solidity))
+        if not isinstance(sam_masks, MaskSet):
+            sam_masks = MaskSet.fromSamMasks(sam_masks, image.shape)
         
+        kept, features = self.keptMasks(image, sam_masks, filterList, testVal, roi, memo, stats)
+        pebble_data = [(int(features["area"][i]), float(features["solidity"][i])) for i in kept]
+        filtered_masks = sam_masks.subset(kept)
         return filtered_masks, pebble_data
-    
 
+    def keptMasks(self, image: np.ndarray, sam_masks: MaskSet, filterList: list, testVal: list = [],
+                  roi: bool=True, memo: dict=None, stats: list=None) -> tuple:
+        """
+        applyfilters without making the MaskSet, returns the indices of the masks kept,
+        smallest first, and the maskFeatures table.
+        """
+        if memo is None:
+            memo = {}
         
+        height, width = image.shape[:2]
+        # Sort masks by area (smallest first)
+        order = np.argsort(sam_masks.area, kind="stable")
+        keep = np.ones(len(sam_masks), dtype=bool)
+        features = None
+        
+        # each stage's result is kept under the settings of it and all the stages before
+        # it, so a change to one filter starts again from that filter
+        # the settings are worked out once for the run
+        settings = [(stage, self.stageEnabled(stage, filterList), tuple(self.stageValues(stage, testVal)))
+                    for stage in self.stages]
+        key = (roi,)
+        cumulative = 0.0
+        for stage, enabled, values in settings:
+            key += ((stage, enabled, values),)
+            masksIn = int(np.count_nonzero(keep))
+            start = time.perf_counter()
+            
+            if key not in memo and enabled:
+                if stage == "features":
+                    memo[key] = self.maskFeatures(sam_masks, order[keep[order]], values[0], roi)
+                else:
+                    memo[key] = keep & self.filterStage(stage, sam_masks, features, order[keep[order]], values,
+                                                        height, width, roi)
+            if key not in memo:
+                memo[key] = keep
+            
+            if stage == "features":
+                features = memo[key]
+            else:
+                keep = memo[key]
+            
+            if stats is not None and enabled:
+                seconds = time.perf_counter() - start
+                cumulative += seconds
+                masksOut = int(np.count_nonzero(keep))
+                stats.append({"filter": stage, "masksIn": masksIn, "masksOut": masksOut,
+                              "rejected": masksIn - masksOut, "seconds": seconds,
+                              "cumulativeSeconds": cumulative})
         
+        return order[keep[order]], features
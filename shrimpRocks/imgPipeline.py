@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+
+class ImagePipeline():
+    """
+    Runs the stages of a batch analysis at the same time rather than one after another.
+    A loader thread reads the images ahead into a bounded queue, the calling thread runs
+    the model on them, and worker threads filter, draw and save the results behind it.
+    OpenCV and PyTorch release the GIL for their heavy work, so the stages overlap and
+    the model is kept busy. The queues are bounded so only a few images are in memory.
+        loadFunc(item) -> loaded
+        inferFunc([loaded, ...]) -> [masks, ...]
+        finishFunc(item, loaded, masks) -> result
+    """
+
+    def __init__(self, loadFunc, inferFunc, finishFunc, batchSize: int=1, workers: int=2, prefetch: int=None):
+        self.loadFunc = loadFunc
+        self.inferFunc = inferFunc
+        self.finishFunc = finishFunc
+        self.batchSize = max(1, batchSize)
+        self.workers = max(1, workers)
+        self.prefetch = prefetch or 2 * self.batchSize
+        self.inferSeconds = 0.0
+        return
+
+    def _put(self, q: queue.Queue, entry) -> bool:
+        """
+        Put that gives up once the pipeline has been stopped by an error.
+        """
+        while not self.stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _fail(self, e: Exception):
+        self.errors.append(e)
+        self.stop.set()
+        return
+
+    def _loader(self, items: list):
+        try:
+            for index, item in enumerate(items):
+                if not self._put(self.loadQueue, (index, item, self.loadFunc(item))):
+                    return
+        except Exception as e:
+            self._fail(e)
+        self._put(self.loadQueue, None)
+        return
+
+    def _finisher(self):
+        while True:
+            entry = self._get(self.finishQueue)
+            if entry is None:
+                return
+            index, item, loaded, masks = entry
+            try:
+                self.results[index] = self.finishFunc(item, loaded, masks)
+            except Exception as e:
+                self._fail(e)
+                return
+
+    def run(self, items: list) -> list:
+        """
+        Returns the finishFunc results in the same order as the items.
+        """
+        self.stop = threading.Event()
+        self.errors = []
+        self.results = [None] * len(items)
+        self.loadQueue = queue.Queue(maxsize=self.prefetch)
+        self.finishQueue = queue.Queue(maxsize=self.workers)
+        self.inferSeconds = 0.0
+
+        loader = threading.Thread(target=self._loader, args=(items,), daemon=True)
+        finishers = [threading.Thread(target=self._finisher, daemon=True) for _ in range(self.workers)]
+        loader.start()
+        for t in finishers:
+            t.start()
+
+        try:
+            finished = False
+            while not finished and not self.stop.is_set():
+                batch = []
+                while len(batch) < self.batchSize:
+                    entry = self._get(self.loadQueue)
+                    if entry is None:
+                        finished = True
+                        break
+                    batch.append(entry)
+                if not batch:
+                    break
+
+                start = time.perf_counter()
+                batch_masks = self.inferFunc([loaded for _, _, loaded in batch])
+                self.inferSeconds += time.perf_counter() - start
+
+                for (index, item, loaded), masks in zip(batch, batch_masks):
+                    if not self._put(self.finishQueue, (index, item, loaded, masks)):
+                        break
+        except BaseException as e:
+            # Ctrl-C or a model error, let the other threads wind down
+            self._fail(e)
+
+        for _ in finishers:
+            self._put(self.finishQueue, None)
+        for t in finishers:
+            t.join()
+        self.stop.set()
+        loader.join()
+
+        if self.errors:
+            raise self.errors[0]
+        return self.results
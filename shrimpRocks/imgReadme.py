@@ -19,8 +19,9 @@ class ImageReadme():
     Generate image files for use in the README.md file to illustrate the filtering steps.
     """
     
-    def __init__(self, oneCentimetre, sourceDir):
+    def __init__(self, oneCentimetre, sourceDir, samSettings=None):
         self.sourceDir = sourceDir
+        self.samSettings = samSettings
         self.windowTitle = "Readme Images"
         self.oneCentimetre = oneCentimetre
         return
@@ -33,16 +34,15 @@ class ImageReadme():
     def makeReadmeImages(self, imgID:int, image_file: str, output_dir: str):
         
         imageUtils = ImageUtilities()        
-        imageAnalyse = ImageAnalyse(self.oneCentimetre, output_dir)
+        imageAnalyse = ImageAnalyse(self.oneCentimetre, output_dir, self.samSettings)
         imageCropping = ImageCropping(output_dir)
         imageFilters = ImageFilters()
-        samProc = SAMprocess()        
+        samProc = SAMprocess(self.samSettings)        
                 
         print(f"Loading image and generating SAM masks for {image_file} (One-time cost)...")
         # 1. Initialization (Run SAM only once)
-        mask_generator = samProc.load_sam()
         image, image_rgb = samProc.load_image(image_file)
-        sam_masks_data = samProc.generate_masks(mask_generator, image_rgb)
+        sam_masks_data = samProc.get_masks(image_rgb)
         
         sourceFile = os.path.join(self.sourceDir,f"Still 2024-09-20 230424_1.2.{imgID}.png")
         try:
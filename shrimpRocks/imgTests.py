@@ -69,10 +69,10 @@ class ImageTests():
         
     
     
-    def segment_pebbles(self, img_bgr, min_area_px=100):
+    def pebbleMarkers(self, img_bgr) -> tuple:
         """
-        Returns an int32 label image where 0 = background and 1..N are pebbles.
-        More shadow-robust using LAB illumination normalization.
+        Steps 1 to 3 of segment_pebbles, returns the cleaned foreground mask, the normalised
+        distance transform and the sure foreground (one blob per pebble).
         """
         
         # --- 1) Flatten shadows/highlights on L channel (LAB) ---
@@ -99,6 +99,16 @@ class ImageTests():
         dist = cv2.distanceTransform(clean, cv2.DIST_L2, 5)
         dist = cv2.normalize(dist, None, 0, 1.0, cv2.NORM_MINMAX)
         sure_fg = (dist > 0.40).astype(np.uint8) * 255      # ↑ raise if over-splitting
+        return clean, dist, sure_fg
+    
+    def segment_pebbles(self, img_bgr, min_area_px=100):
+        """
+        Returns an int32 label image where 0 = background and 1..N are pebbles.
+        More shadow-robust using LAB illumination normalization.
+        """
+        
+        k3 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        clean, dist, sure_fg = self.pebbleMarkers(img_bgr)
         sure_bg = cv2.dilate(clean, k3, 3)
         unknown = cv2.subtract(sure_bg, sure_fg)
 
@@ -4,7 +4,8 @@
 import cv2
 import numpy as np
 import os
-import tkinter as tk
+
+from shrimpRocks.maskSet import MaskSet
 
 class ImageUtilities:
     
@@ -39,6 +40,36 @@ class ImageUtilities:
         cv2.destroyAllWindows()       
         return
     
+    def drawMasks(self, image, masks):
+        """
+        The image with the masks filled in green and outlined in red, masks is a MaskSet
+        or a list of SAM mask dictionaries.
+        """
+        if not isinstance(masks, MaskSet):
+            masks = MaskSet.fromSamMasks(masks, image.shape)
+        output_image = image.copy()
+        
+        outline_color = (0, 0, 255)  
+        outline_thickness = 2        
+        fill_color = (0, 255, 0) 
+    
+        overlay = np.zeros_like(output_image, dtype=np.uint8)
+        
+        # 1. Draw Fill, only inside each mask's box
+        for i in range(len(masks)):
+            x, y, w, h = masks.boxes[i]
+            overlay[y:y + h, x:x + w][masks.crop(i)] = fill_color
+
+        alpha = 0.5 
+        output_image = cv2.addWeighted(output_image, 1 - alpha, overlay, alpha, 0)
+
+        # 2. Draw Outline
+        for i in range(len(masks)):
+            contours = masks.contours(i)
+            cv2.drawContours(output_image, contours, -1, outline_color, outline_thickness)
+
+        return output_image
+    
     def saveImage(self, filename: str, image: list[np.ndarray]):
         
         # print(filename)
@@ -136,6 +167,8 @@ class ImageUtilities:
         return
 
     def getCurrentScreenRes(self) -> tuple:
+        import tkinter as tk
+        
         root = tk.Tk()
         root.withdraw()  # Hides the tkinter window
         width = root.winfo_screenwidth()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+
+
+class MaskSet():
+    """
+    The SAM masks for one image kept compactly. Each mask is cropped to its bounding box
+    and bit packed, the per-mask values SAM supplies are held in flat arrays, so memory
+    grows with the pebble pixels rather than the image size times the mask count. Full
+    frame masks are only made one at a time when something asks for them.
+        boxes:  x, y, w, h of each crop, the same as cv2.boundingRect of the mask
+        bbox:   the box SAM reported, kept so the masks can be written back unchanged
+    """
+
+    def __init__(self, shape: tuple):
+        self.shape = tuple(int(v) for v in shape[:2])
+        self.bits = []
+        self.boxes = np.zeros((0, 4), dtype=np.int32)
+        self.area = np.zeros(0, dtype=np.int64)
+        self.bbox = np.zeros((0, 4), dtype=np.int64)
+        self.predicted_iou = np.zeros(0, dtype=np.float64)
+        self.stability_score = np.zeros(0, dtype=np.float64)
+        self.point_coords = np.zeros((0, 2), dtype=np.float64)
+        self.crop_box = np.zeros((0, 4), dtype=np.int64)
+        return
+
+    def __len__(self) -> int:
+        return len(self.bits)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.boxes, self.area, self.bbox, self.predicted_iou, self.stability_score,
+                  self.point_coords, self.crop_box)
+        return sum(b.nbytes for b in self.bits) + sum(a.nbytes for a in arrays)
+
+    def packMask(self, mask: np.ndarray) -> tuple:
+        """
+        Crop a full frame mask to its bounding box, returns (packed bits, box).
+        """
+        mask = np.ascontiguousarray(mask, dtype=bool)
+        x, y, w, h = cv2.boundingRect(mask.view(np.uint8))
+        crop = mask[y:y + h, x:x + w]
+        return np.packbits(crop, axis=None), (x, y, w, h)
+
+    def decodeRLE(self, counts, shape: tuple) -> np.ndarray:
+        """
+        Column major run lengths (SAM's uncompressed_rle layout, the first run counts zeros)
+        to a boolean (height, width) mask.
+        """
+        values = (np.arange(len(counts)) % 2).astype(bool)
+        flat = np.repeat(values, np.asarray(counts, dtype=np.int64))
+        return flat.reshape((shape[1], shape[0])).T
+
+    def encodeRLE(self, mask: np.ndarray) -> np.ndarray:
+        """
+        A boolean mask to column major run lengths, the first run always counts zeros so it may be 0.
+        """
+        flat = np.asarray(mask, dtype=bool).ravel(order="F")
+        if flat.size == 0:
+            return np.zeros(1, dtype=np.int32)
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        bounds = np.concatenate(([0], changes, [flat.size]))
+        runs = np.diff(bounds)
+        if flat[0]:
+            runs = np.concatenate(([0], runs))
+        return runs.astype(np.int32)
+
+    @classmethod
+    def fromSamMasks(cls, sam_masks: list, shape: tuple):
+        """
+        Build from the SamAutomaticMaskGenerator output, the segmentation can be a boolean
+        mask (output_mode "binary_mask") or a {"size", "counts"} run length dictionary
+        (output_mode "uncompressed_rle").
+        """
+        maskSet = cls(shape)
+        boxes = []
+        for m in sam_masks:
+            segmentation = m["segmentation"]
+            if isinstance(segmentation, dict):
+                segmentation = maskSet.decodeRLE(segmentation["counts"], segmentation["size"])
+            bits, box = maskSet.packMask(segmentation)
+            maskSet.bits.append(bits)
+            boxes.append(box)
+
+        count = len(sam_masks)
+        maskSet.boxes = np.array(boxes, dtype=np.int32).reshape(count, 4)
+        maskSet.area = np.array([m.get("area", 0) for m in sam_masks], dtype=np.int64)
+        maskSet.bbox = np.array([m.get("bbox", [0] * 4) for m in sam_masks], dtype=np.int64).reshape(count, 4)
+        maskSet.predicted_iou = np.array([m.get("predicted_iou", 0) for m in sam_masks], dtype=np.float64)
+        maskSet.stability_score = np.array([m.get("stability_score", 0) for m in sam_masks], dtype=np.float64)
+        maskSet.point_coords = np.array([m.get("point_coords", [[0, 0]])[0] for m in sam_masks],
+                                        dtype=np.float64).reshape(count, 2)
+        maskSet.crop_box = np.array([m.get("crop_box", [0] * 4) for m in sam_masks], dtype=np.int64).reshape(count, 4)
+        return maskSet
+
+    @classmethod
+    def fromLabels(cls, labels: np.ndarray):
+        """
+        Build from a label image (0 background, 1..N one region each), as the watershed
+        segmenter makes. The boxes come from the labelled pixels' coordinates, so each mask
+        is only ever made inside its box. Regions do not overlap and have no score, so
+        predicted_iou and stability_score are 1 and point_coords is the centroid.
+        """
+        labels = np.asarray(labels)
+        height, width = labels.shape[:2]
+        maskSet = cls(labels.shape)
+        ys, xs = np.nonzero(labels > 0)
+        values = labels[ys, xs].astype(np.int64)
+        count = int(values.max()) + 1 if len(values) else 1
+        area = np.bincount(values, minlength=count)
+        present = np.flatnonzero(area[1:]) + 1
+
+        x0 = np.full(count, width, dtype=np.int64)
+        y0 = np.full(count, height, dtype=np.int64)
+        x1 = np.zeros(count, dtype=np.int64)
+        y1 = np.zeros(count, dtype=np.int64)
+        np.minimum.at(x0, values, xs)
+        np.minimum.at(y0, values, ys)
+        np.maximum.at(x1, values, xs)
+        np.maximum.at(y1, values, ys)
+        cx = np.bincount(values, weights=xs, minlength=count)
+        cy = np.bincount(values, weights=ys, minlength=count)
+
+        boxes = []
+        for label in present:
+            x, y, w, h = int(x0[label]), int(y0[label]), int(x1[label] - x0[label] + 1), int(y1[label] - y0[label] + 1)
+            maskSet.bits.append(np.packbits(labels[y:y + h, x:x + w] == label, axis=None))
+            boxes.append((x, y, w, h))
+
+        total = len(present)
+        maskSet.boxes = np.array(boxes, dtype=np.int32).reshape(total, 4)
+        maskSet.area = area[present].astype(np.int64)
+        maskSet.bbox = maskSet.boxes.astype(np.int64)
+        maskSet.predicted_iou = np.ones(total, dtype=np.float64)
+        maskSet.stability_score = np.ones(total, dtype=np.float64)
+        maskSet.point_coords = np.stack([cx[present], cy[present]], axis=1).reshape(total, 2) / np.maximum(area[present], 1)[:, None]
+        maskSet.crop_box = np.tile(np.array([0, 0, width, height], dtype=np.int64), (total, 1))
+        return maskSet
+
+    def subset(self, indices) -> "MaskSet":
+        """
+        A MaskSet of the given masks in the given order, the packed bits are shared.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        other = MaskSet(self.shape)
+        other.bits = [self.bits[i] for i in indices]
+        other.boxes = self.boxes[indices]
+        other.area = self.area[indices]
+        other.bbox = self.bbox[indices]
+        other.predicted_iou = self.predicted_iou[indices]
+        other.stability_score = self.stability_score[indices]
+        other.point_coords = self.point_coords[indices]
+        other.crop_box = self.crop_box[indices]
+        return other
+
+    def crop(self, i: int) -> np.ndarray:
+        """
+        The boolean mask inside its box.
+        """
+        _, _, w, h = self.boxes[i]
+        return np.unpackbits(self.bits[i], count=int(w * h)).reshape(h, w).view(bool)
+
+    def paddedCrop(self, i: int, pad: int=1) -> tuple:
+        """
+        The crop as a 0/255 uint8 image with a border of pad pixels and the image position
+        of its top left corner. A border of 1 gives findContours the same result it gives
+        on the full frame, offset by that position.
+        """
+        x, y, w, h = self.boxes[i]
+        padded = np.zeros((h + 2 * pad, w + 2 * pad), dtype=np.uint8)
+        padded[pad:pad + h, pad:pad + w] = self.crop(i).view(np.uint8) * 255
+        return padded, (int(x) - pad, int(y) - pad)
+
+    def contours(self, i: int) -> list:
+        """
+        External contours of the mask in image coordinates.
+        """
+        padded, offset = self.paddedCrop(i)
+        contours, _ = cv2.findContours(padded, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        return contours
+
+    def full(self, i: int) -> np.ndarray:
+        """
+        The mask as a full frame boolean image, only for code that needs one.
+        """
+        x, y, w, h = self.boxes[i]
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[y:y + h, x:x + w] = self.crop(i)
+        return mask
+
+    def contains(self, i: int, x: int, y: int) -> bool:
+
+        bx, by, w, h = self.boxes[i]
+        if not (bx <= x < bx + w and by <= y < by + h):
+            return False
+        return bool(self.crop(i)[y - by, x - bx])
+
+    def overlap(self, i: int, other: "MaskSet", j: int) -> tuple:
+        """
+        (intersection, union) pixel counts of mask i here and mask j in other, only the
+        area where the two boxes overlap is looked at.
+        """
+        ax, ay, aw, ah = (int(v) for v in self.boxes[i])
+        bx, by, bw, bh = (int(v) for v in other.boxes[j])
+        areaA = int(self.crop(i).sum())
+        areaB = int(other.crop(j).sum())
+
+        x0, y0 = max(ax, bx), max(ay, by)
+        x1, y1 = min(ax + aw, bx + bw), min(ay + ah, by + bh)
+        if x1 <= x0 or y1 <= y0:
+            return 0, areaA + areaB
+
+        cropA = self.crop(i)[y0 - ay:y1 - ay, x0 - ax:x1 - ax]
+        cropB = other.crop(j)[y0 - by:y1 - by, x0 - bx:x1 - bx]
+        inter = int(np.logical_and(cropA, cropB).sum())
+        return inter, areaA + areaB - inter
+
+    def boxPairs(self, cell: int=64, indices=None) -> list:
+        """
+        The (i, j) pairs, i < j, whose boxes intersect, only among indices when given. The
+        boxes are put in a grid of cell sized squares so only masks sharing a square are
+        compared, rather than every mask against every other.
+        """
+        if indices is None:
+            indices = range(len(self))
+        grid = {}
+        for i in indices:
+            x, y, w, h = self.boxes[i]
+            for gy in range(y // cell, (y + max(h, 1) - 1) // cell + 1):
+                for gx in range(x // cell, (x + max(w, 1) - 1) // cell + 1):
+                    grid.setdefault((gx, gy), []).append(i)
+
+        pairs = set()
+        for members in grid.values():
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    pairs.add((min(members[a], members[b]), max(members[a], members[b])))
+
+        x0, y0 = self.boxes[:, 0], self.boxes[:, 1]
+        x1, y1 = x0 + self.boxes[:, 2], y0 + self.boxes[:, 3]
+        # sharing a grid square does not mean the boxes meet
+        return sorted((i, j) for i, j in pairs
+                      if min(x1[i], x1[j]) > max(x0[i], x0[j]) and min(y1[i], y1[j]) > max(y0[i], y0[j]))
+
+    def boxIntersection(self, i: int, j: int) -> int:
+
+        ax, ay, aw, ah = (int(v) for v in self.boxes[i])
+        bx, by, bw, bh = (int(v) for v in self.boxes[j])
+        w = min(ax + aw, bx + bw) - max(ax, bx)
+        h = min(ay + ah, by + bh) - max(ay, by)
+        return max(w, 0) * max(h, 0)
+
+    def rle(self, i: int) -> np.ndarray:
+        return self.encodeRLE(self.full(i))
+
+    def toSamMasks(self) -> list:
+        """
+        The list of dictionaries SamAutomaticMaskGenerator returns, with full frame masks.
+        """
+        sam_masks = []
+        for i in range(len(self)):
+            sam_masks.append({
+                "segmentation": self.full(i),
+                "area": int(self.area[i]),
+                "bbox": self.bbox[i].tolist(),
+                "predicted_iou": float(self.predicted_iou[i]),
+                "point_coords": [self.point_coords[i].tolist()],
+                "stability_score": float(self.stability_score[i]),
+                "crop_box": self.crop_box[i].tolist(),
+            })
+        return sam_masks
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from shrimpRocks.maskSet import MaskSet
+
+# numpy 2 has a popcount, for older versions count the bits of each byte with a table
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _bitsTable = np.array([bin(v).count("1") for v in range(256)], dtype=np.uint8)
+    def _popcount(a):
+        return _bitsTable[a]
+
+
+class OcclusionMap():
+    """
+    The pebbles accepted so far for the occlusion filter. A label map holds which accepted
+    mask covers each pixel (0 for none) and the covered pixel count is kept as masks are
+    added, so a candidate is only compared with the map inside its own box rather than
+    over the whole image. The IoU and overlap_self are the same as occlusionMask's.
+        packed: also keep the covered pixels as bit packed rows, the overlap is then
+                counted a byte (8 pixels) at a time with a popcount.
+    """
+
+    def __init__(self, shape: tuple, packed: bool=False):
+        self.shape = tuple(int(v) for v in shape[:2])
+        self.labels = np.zeros(self.shape, dtype=np.int32)
+        self.area = 0
+        self.packed = packed
+        if packed:
+            self.bits = np.zeros((self.shape[0], (self.shape[1] + 7) // 8), dtype=np.uint8)
+        return
+
+    def _packedWindow(self, maskSet: MaskSet, i: int) -> tuple:
+        """
+        The mask's crop widened to whole bytes and packed by row, with the slices of
+        self.bits it lines up with.
+        """
+        x, y, w, h = (int(v) for v in maskSet.boxes[i])
+        b0, b1 = x // 8, (x + w + 7) // 8
+        wide = np.zeros((h, 8 * (b1 - b0)), dtype=bool)
+        wide[:, x - 8 * b0:x - 8 * b0 + w] = maskSet.crop(i)
+        return np.packbits(wide, axis=1), (slice(y, y + h), slice(b0, b1))
+
+    def overlap(self, maskSet: MaskSet, i: int) -> tuple:
+        """
+        (pixels of mask i already covered, pixels in mask i)
+        """
+        x, y, w, h = maskSet.boxes[i]
+        crop = maskSet.crop(i)
+        area = int(np.count_nonzero(crop))
+        if self.packed:
+            rows, window = self._packedWindow(maskSet, i)
+            inter = int(_popcount(rows & self.bits[window]).sum(dtype=np.int64))
+        else:
+            inter = int(np.count_nonzero(self.labels[y:y + h, x:x + w][crop]))
+        return inter, area
+
+    def test(self, maskSet: MaskSet, i: int, iou_thresh: float, overlap_self_thresh: float) -> dict:
+        """
+        How much mask i overlaps the accepted masks, as {"occluded", "iou", "overlap_self"}.
+        """
+        inter, area_cur = self.overlap(maskSet, i)
+        if inter == 0:
+            return {"occluded": False, "iou": 0.0, "overlap_self": 0.0}
+
+        union = area_cur + self.area - inter
+        iou = inter / (union + 1e-6)
+        overlap_self = inter / (area_cur + 1e-6)
+        occluded = (iou > iou_thresh) or (overlap_self > overlap_self_thresh)
+        return {"occluded": occluded, "iou": iou, "overlap_self": overlap_self}
+
+    def add(self, maskSet: MaskSet, i: int, label: int):
+        """
+        Accept mask i, pixels already covered keep the label they have.
+        """
+        x, y, w, h = maskSet.boxes[i]
+        window = self.labels[y:y + h, x:x + w]
+        new = maskSet.crop(i) & (window == 0)
+        window[new] = label
+        self.area += int(np.count_nonzero(new))
+        if self.packed:
+            rows, bitsWindow = self._packedWindow(maskSet, i)
+            self.bits[bitsWindow] |= rows
+        return
+
+    def check(self, maskSet: MaskSet, i: int, iou_thresh: float, overlap_self_thresh: float) -> dict:
+        """
+        test, then add the mask when it is not occluded, labelled by its index + 1.
+        """
+        info = self.test(maskSet, i, iou_thresh, overlap_self_thresh)
+        if not info["occluded"]:
+            self.add(maskSet, i, i + 1)
+        return info
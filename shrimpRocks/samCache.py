@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import hashlib
+import numpy as np
+
+from shrimpRocks.maskSet import MaskSet
+
+
+class MaskCache():
+    """
+    On-disk cache of the SamAutomaticMaskGenerator output, keyed by a hash of the image
+    pixels, the model type and the generator parameters. Each entry is a single .npz file
+    holding the masks as run length encoding plus the per-mask values SAM supplies.
+    """
+
+    def __init__(self, cacheDir: str=".samcache/", maxMB: int=2048):
+        self.cacheDir = cacheDir
+        self.maxBytes = int(maxMB) * 1024 * 1024
+        self.suffix = ".npz"
+        return
+
+    def makeKey(self, image_rgb: np.ndarray, modelType: str, params: dict) -> str:
+        """
+        Content address for an image, anything that changes the masks must be part of the key.
+        """
+        h = hashlib.sha256()
+        h.update(str(image_rgb.shape).encode())
+        h.update(np.ascontiguousarray(image_rgb).tobytes())
+        h.update(modelType.encode())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def entryPath(self, key: str) -> str:
+        return os.path.join(self.cacheDir, key + self.suffix)
+
+    def masksToBytes(self, maskSet: MaskSet) -> bytes:
+        """
+        Pack a MaskSet into npz bytes, the masks are stored as full frame run lengths in
+        the same layout as SAM's uncompressed_rle.
+        """
+        rles = [maskSet.rle(i) for i in range(len(maskSet))]
+        lengths = np.array([len(r) for r in rles], dtype=np.int64)
+        counts = np.concatenate(rles) if rles else np.zeros(0, dtype=np.int32)
+
+        buf = io.BytesIO()
+        np.savez_compressed(
+            buf,
+            shape=np.array(maskSet.shape, dtype=np.int64),
+            counts=counts,
+            lengths=lengths,
+            area=maskSet.area,
+            bbox=maskSet.bbox,
+            predicted_iou=maskSet.predicted_iou,
+            stability_score=maskSet.stability_score,
+            point_coords=maskSet.point_coords,
+            crop_box=maskSet.crop_box,
+        )
+        return buf.getvalue()
+
+    def bytesToMasks(self, data: bytes) -> MaskSet:
+        """
+        Unpack npz bytes from masksToBytes into a MaskSet, one mask at a time.
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            maskSet = MaskSet(tuple(int(v) for v in npz["shape"]))
+            counts = npz["counts"]
+            ends = np.cumsum(npz["lengths"])
+            starts = ends - npz["lengths"]
+            boxes = []
+            for i in range(len(ends)):
+                bits, box = maskSet.packMask(maskSet.decodeRLE(counts[starts[i]:ends[i]], maskSet.shape))
+                maskSet.bits.append(bits)
+                boxes.append(box)
+            maskSet.boxes = np.array(boxes, dtype=np.int32).reshape(len(ends), 4)
+            maskSet.area = npz["area"].astype(np.int64)
+            maskSet.bbox = npz["bbox"].astype(np.int64).reshape(len(ends), 4)
+            maskSet.predicted_iou = npz["predicted_iou"].astype(np.float64)
+            maskSet.stability_score = npz["stability_score"].astype(np.float64)
+            maskSet.point_coords = npz["point_coords"].astype(np.float64).reshape(len(ends), 2)
+            maskSet.crop_box = npz["crop_box"].astype(np.int64).reshape(len(ends), 4)
+        return maskSet
+
+    def load(self, key: str) -> MaskSet:
+        """
+        Returns the cached MaskSet or None, a hit marks the entry as recently used.
+        """
+        path = self.entryPath(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                maskSet = self.bytesToMasks(f.read())
+        except Exception as e:
+            print(f"Ignoring unreadable cache entry: {path}")
+            print(e)
+            self.invalidate(key)
+            return None
+
+        os.utime(path, None)
+        return maskSet
+
+    def save(self, key: str, maskSet: MaskSet):
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+        path = self.entryPath(key)
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmpPath, "wb") as f:
+                f.write(self.masksToBytes(maskSet))
+            os.replace(tmpPath, path)
+        except Exception as e:
+            print(f"Cannot write cache entry: {path}")
+            print(e)
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+
+        self.evict()
+        return
+
+    def entries(self) -> list:
+        """
+        Cache entries as (path, size, last used), oldest first.
+        """
+        if not os.path.isdir(self.cacheDir):
+            return []
+
+        found = []
+        for file in os.listdir(self.cacheDir):
+            if not file.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cacheDir, file)
+            st = os.stat(path)
+            found.append((path, st.st_size, st.st_mtime))
+        return sorted(found, key=lambda e: e[2])
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in maxBytes.
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for path, size, _ in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        return
+
+    def invalidate(self, key: str):
+
+        path = self.entryPath(key)
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    def clear(self) -> int:
+        """
+        Delete every entry, returns the number removed.
+        """
+        entries = self.entries()
+        for path, _, _ in entries:
+            os.remove(path)
+        return len(entries)
+
+
+class EmbeddingCache(MaskCache):
+    """
+    On-disk cache of the SAM image encoder output, keyed by a hash of the image pixels and
+    the model only, so the masks can be made again with different generator settings
+    without running the encoder. Each entry is a single .npy file that is memory mapped
+    when loaded.
+    """
+
+    def __init__(self, cacheDir: str=".samembed/", maxMB: int=4096):
+        super().__init__(cacheDir, maxMB)
+        self.suffix = ".npy"
+        return
+
+    def makeKey(self, image_rgb: np.ndarray, modelType: str) -> str:
+        return super().makeKey(image_rgb, modelType, {})
+
+    def load(self, key: str) -> np.ndarray:
+        """
+        Returns the cached embedding as a read only memory mapped array, or None.
+        """
+        path = self.entryPath(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            features = np.load(path, mmap_mode="r", allow_pickle=False)
+        except Exception as e:
+            print(f"Ignoring unreadable cache entry: {path}")
+            print(e)
+            self.invalidate(key)
+            return None
+
+        os.utime(path, None)
+        return features
+
+    def save(self, key: str, features: np.ndarray):
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+        path = self.entryPath(key)
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        try:
+            # np.save adds .npy to a file name, so write through the file object
+            with open(tmpPath, "wb") as f:
+                np.save(f, np.ascontiguousarray(features, dtype=np.float32), allow_pickle=False)
+            os.replace(tmpPath, path)
+        except Exception as e:
+            print(f"Cannot write cache entry: {path}")
+            print(e)
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            return
+
+        self.evict()
+        return
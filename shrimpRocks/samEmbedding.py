@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+class SAMembedding():
+    """
+    Runs the SAM image encoder separately from the mask generator, so that several images
+    can be embedded in one forward pass and the prompt decoding started from those
+    embeddings.
+    """
+
+    def __init__(self):
+        return
+
+    def prepareImage(self, sam, image_rgb: np.ndarray) -> tuple:
+        """
+        The same resize, normalise and pad that SamPredictor.set_image does, returns the
+        1x3xSxS input tensor, the original (h, w) and the resized (h, w).
+        """
+        transform = ResizeLongestSide(sam.image_encoder.img_size)
+        if sam.image_format != "RGB":
+            image_rgb = image_rgb[..., ::-1]
+
+        input_image = transform.apply_image(image_rgb)
+        input_torch = torch.as_tensor(input_image, device=sam.device)
+        input_torch = input_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        input_size = tuple(input_torch.shape[-2:])
+        return sam.preprocess(input_torch), tuple(image_rgb.shape[:2]), input_size
+
+    def embedImages(self, sam, images_rgb: list) -> list:
+        """
+        Encode all the images in a single batch, returns one embedding dictionary per image.
+        """
+        prepared = [self.prepareImage(sam, img) for img in images_rgb]
+        batch = torch.cat([p[0] for p in prepared], dim=0)
+
+        with torch.inference_mode():
+            features = sam.image_encoder(batch)
+
+        embeddings = []
+        for i, (_, original_size, input_size) in enumerate(prepared):
+            embeddings.append({
+                "features": features[i:i+1],
+                "original_size": original_size,
+                "input_size": input_size
+            })
+        return embeddings
+
+    def encodeImage(self, predictor, image_rgb: np.ndarray) -> dict:
+        """
+        Run the predictor's encoder on one image and return its embedding dictionary, works
+        for SamPredictor and the ONNX predictor.
+        """
+        predictor.set_image(image_rgb)
+        return {
+            "features": predictor.features,
+            "original_size": predictor.original_size,
+            "input_size": predictor.input_size
+        }
+
+    def featuresToArray(self, embedding: dict) -> np.ndarray:
+
+        features = embedding["features"]
+        if isinstance(features, torch.Tensor):
+            features = features.detach().float().cpu().numpy()
+        return features
+
+    def embeddingFromArray(self, predictor, features: np.ndarray, image_rgb: np.ndarray) -> dict:
+        """
+        Rebuild the embedding dictionary for an image from saved encoder features, the sizes
+        follow from the image the same way set_image works them out.
+        """
+        original_size = tuple(image_rgb.shape[:2])
+        input_size = ResizeLongestSide.get_preprocess_shape(original_size[0], original_size[1],
+                                                            predictor.transform.target_length)
+        if isinstance(predictor, SamPredictor):
+            features = torch.from_numpy(np.array(features)).to(predictor.device)
+        else:
+            features = np.ascontiguousarray(features)
+        return {
+            "features": features,
+            "original_size": original_size,
+            "input_size": input_size
+        }
+
+    def applyEmbedding(self, predictor, embedding: dict):
+        """
+        Puts a SamPredictor in the state set_image would have left it in.
+        """
+        predictor.reset_image()
+        predictor.original_size = embedding["original_size"]
+        predictor.input_size = embedding["input_size"]
+        predictor.features = embedding["features"]
+        predictor.is_image_set = True
+        return
+
+    def generate(self, mask_generator, image_rgb: np.ndarray, embedding: dict) -> list:
+        """
+        Run SamAutomaticMaskGenerator.generate with the whole image embedding already
+        computed. Only the full image crop uses it, any smaller crops (crop_n_layers > 0)
+        still go through the encoder as normal.
+        """
+        predictor = mask_generator.predictor
+        set_image = predictor.set_image
+
+        def set_image_from_embedding(image, image_format="RGB"):
+            if tuple(image.shape[:2]) == tuple(embedding["original_size"]):
+                self.applyEmbedding(predictor, embedding)
+            else:
+                set_image(image, image_format)
+
+        predictor.set_image = set_image_from_embedding
+        try:
+            sam_masks = mask_generator.generate(image_rgb)
+        finally:
+            del predictor.set_image
+        return sam_masks
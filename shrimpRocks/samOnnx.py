@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import types
+import numpy as np
+import torch
+from torch.nn import functional as F
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.onnx import SamOnnxModel
+from segment_anything.utils.transforms import ResizeLongestSide
+
+# sudo apt install python3-onnxruntime python3-onnx
+
+
+class OnnxDecoder(SamOnnxModel):
+    """
+    The prompt encoder and mask decoder without the upscaling, SamOnnxModel fixes the crop
+    to the image size used for the export, so the low resolution masks are upscaled
+    afterwards by OnnxPredictor in the same way as Sam.postprocess_masks.
+    """
+
+    @torch.no_grad()
+    def forward(self, image_embeddings, point_coords, point_labels):
+        sparse_embedding = self._embed_points(point_coords, point_labels)
+        dense_embedding = self.model.prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+
+        masks, scores = self.model.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embedding,
+            dense_prompt_embeddings=dense_embedding,
+        )
+        return scores, masks
+
+
+class OnnxPredictor():
+    """
+    Stands in for SamPredictor inside SamAutomaticMaskGenerator, the image encoder and the
+    prompt decoder run through ONNX Runtime sessions instead of PyTorch. Only the parts of
+    the SamPredictor interface the mask generator uses are provided.
+    """
+
+    def __init__(self, encoderSession, decoderSession, img_size: int=1024):
+        self.encoder = encoderSession
+        self.decoder = decoderSession
+        self.transform = ResizeLongestSide(img_size)
+        self.img_size = img_size
+        self.device = "cpu"
+        self.model = types.SimpleNamespace(mask_threshold=0.0, image_format="RGB")
+        # the same normalisation as Sam.preprocess
+        self.pixel_mean = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+        self.pixel_std = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+        self.batchDecoder = True
+        self.reset_image()
+        return
+
+    def reset_image(self):
+        self.is_image_set = False
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        return
+
+    def preprocess(self, image_rgb: np.ndarray) -> np.ndarray:
+        """
+        Resize the long side to img_size, normalise and pad to a square 1x3xSxS array.
+        """
+        resized = self.transform.apply_image(image_rgb)
+        h, w = resized.shape[:2]
+        normalised = (resized.astype(np.float32) - self.pixel_mean) / self.pixel_std
+        padded = np.zeros((self.img_size, self.img_size, 3), dtype=np.float32)
+        padded[:h, :w] = normalised
+        return padded.transpose(2, 0, 1)[None], (h, w)
+
+    def set_image(self, image: np.ndarray, image_format: str="RGB"):
+        if image_format != self.model.image_format:
+            image = image[..., ::-1]
+
+        input_image, input_size = self.preprocess(image)
+        self.reset_image()
+        self.original_size = tuple(image.shape[:2])
+        self.input_size = input_size
+        self.features = self.encoder.run(None, {"input_image": input_image})[0]
+        self.is_image_set = True
+        return
+
+    def runDecoder(self, point_coords: np.ndarray, point_labels: np.ndarray) -> tuple:
+
+        inputs = {
+            "image_embeddings": self.features,
+            "point_coords": point_coords.astype(np.float32),
+            "point_labels": point_labels.astype(np.float32)
+        }
+        return self.decoder.run(None, inputs)
+
+    def postprocess_masks(self, low_res: torch.Tensor) -> torch.Tensor:
+        """
+        Upscale, remove the padding and resize to the original image, as Sam.postprocess_masks.
+        """
+        masks = F.interpolate(low_res, (self.img_size, self.img_size), mode="bilinear", align_corners=False)
+        masks = masks[..., : self.input_size[0], : self.input_size[1]]
+        return F.interpolate(masks, self.original_size, mode="bilinear", align_corners=False)
+
+    def predict_torch(self, point_coords, point_labels, boxes=None, mask_input=None,
+                      multimask_output: bool=True, return_logits: bool=False) -> tuple:
+        """
+        Same results as SamPredictor.predict_torch for point prompts, the points are
+        already in the resized image coordinates.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        coords = point_coords.cpu().numpy()
+        labels = point_labels.cpu().numpy()
+        # SAM's prompt encoder adds a padding point when there is no box
+        coords = np.concatenate([coords, np.zeros((coords.shape[0], 1, 2))], axis=1)
+        labels = np.concatenate([labels, -np.ones((labels.shape[0], 1))], axis=1)
+
+        if self.batchDecoder:
+            try:
+                iou_preds, low_res = self.runDecoder(coords, labels)
+            except Exception:
+                # decoder exported without a dynamic batch axis
+                self.batchDecoder = False
+
+        if not self.batchDecoder:
+            outputs = [self.runDecoder(coords[i:i+1], labels[i:i+1]) for i in range(coords.shape[0])]
+            iou_preds, low_res = (np.concatenate(o, axis=0) for o in zip(*outputs))
+
+        # the decoder returns all the mask tokens, the first is the single mask output
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        iou_preds = torch.from_numpy(iou_preds[:, mask_slice])
+        low_res = torch.from_numpy(low_res[:, mask_slice])
+        masks = self.postprocess_masks(low_res)
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+        return masks, iou_preds, low_res
+
+
+class SAMonnx():
+    """
+    Export the SAM image encoder and prompt decoder to ONNX and build a mask generator
+    that runs them with ONNX Runtime on the CPU.
+    """
+
+    def __init__(self, onnxDir: str=".samonnx/", modelType: str="vit_h", checkpointPath: str="sam_vit_h_4b8939.pth"):
+        self.onnxDir = onnxDir
+        self.modelType = modelType
+        self.checkpointPath = checkpointPath
+        self.opset = 17
+        return
+
+    def modelName(self) -> str:
+        # the checkpoint is in the name, so an export from a fine-tuned checkpoint does not
+        # replace the stock one, as SAMprecision.quantisedPath does
+        name = os.path.splitext(os.path.basename(self.checkpointPath))[0]
+        return f"{self.modelType}_{name}"
+
+    def encoderPath(self) -> str:
+        return os.path.join(self.onnxDir, f"{self.modelName()}_encoder.onnx")
+
+    def decoderPath(self) -> str:
+        return os.path.join(self.onnxDir, f"{self.modelName()}_decoder.onnx")
+
+    def exportModels(self, sam):
+        """
+        Write the encoder and decoder for the model.
+        """
+        if not os.path.isdir(self.onnxDir):
+            os.makedirs(self.onnxDir, exist_ok=True)
+
+        sam = sam.to("cpu").eval()
+        img_size = sam.image_encoder.img_size
+
+        print(f"exporting image encoder to: {self.encoderPath()}")
+        dummy_image = torch.randn(1, 3, img_size, img_size, dtype=torch.float32)
+        with torch.no_grad():
+            torch.onnx.export(
+                sam.image_encoder, (dummy_image,), self.encoderPath(),
+                input_names=["input_image"], output_names=["image_embeddings"],
+                opset_version=self.opset, do_constant_folding=True, dynamo=False
+            )
+
+        print(f"exporting prompt decoder to: {self.decoderPath()}")
+        decoder = OnnxDecoder(sam, return_single_mask=False)
+        embed_dim = sam.prompt_encoder.embed_dim
+        embed_size = sam.prompt_encoder.image_embedding_size
+        dummy_inputs = {
+            "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+            "point_coords": torch.randint(low=0, high=img_size, size=(2, 2, 2), dtype=torch.float),
+            "point_labels": torch.randint(low=0, high=4, size=(2, 2), dtype=torch.float),
+        }
+        dynamic_axes = {
+            "point_coords": {0: "batch", 1: "num_points"},
+            "point_labels": {0: "batch", 1: "num_points"},
+            "iou_predictions": {0: "batch"},
+            "low_res_masks": {0: "batch"},
+        }
+        with torch.no_grad():
+            torch.onnx.export(
+                decoder, tuple(dummy_inputs.values()), self.decoderPath(),
+                input_names=list(dummy_inputs.keys()),
+                output_names=["iou_predictions", "low_res_masks"],
+                dynamic_axes=dynamic_axes, opset_version=self.opset,
+                do_constant_folding=True, dynamo=False
+            )
+
+        print("export done")
+        return
+
+    def loadSessions(self) -> tuple:
+
+        try:
+            import onnxruntime
+        except ImportError:
+            print("The ONNX runtime needs onnxruntime: sudo apt install python3-onnxruntime")
+            sys.exit()
+
+        for path in (self.encoderPath(), self.decoderPath()):
+            if not os.path.isfile(path):
+                print(f"ONNX model not found: {path}")
+                print(f"Export it first with: python shrimpRocks.py --onnxexport --model {self.modelType} --checkpoint {self.checkpointPath}")
+                sys.exit()
+
+        providers = ["CPUExecutionProvider"]
+        encoder = onnxruntime.InferenceSession(self.encoderPath(), providers=providers)
+        decoder = onnxruntime.InferenceSession(self.decoderPath(), providers=providers)
+        return encoder, decoder
+
+    def makeGenerator(self, generatorParams: dict) -> SamAutomaticMaskGenerator:
+        """
+        A SamAutomaticMaskGenerator whose predictor is the OnnxPredictor, so the point grid,
+        filtering, NMS and the mask dictionaries are exactly those of the torch path.
+        """
+        encoder, decoder = self.loadSessions()
+        img_size = encoder.get_inputs()[0].shape[-1]
+        if not isinstance(img_size, int):
+            img_size = 1024
+
+        # SamPredictor is built from the model passed in, it only needs the encoder size
+        placeholder = types.SimpleNamespace(image_encoder=types.SimpleNamespace(img_size=img_size))
+        mask_generator = SamAutomaticMaskGenerator(placeholder, output_mode="uncompressed_rle", **generatorParams)
+        mask_generator.predictor = OnnxPredictor(encoder, decoder, img_size)
+        return mask_generator
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import torch
+
+
+class BF16Encoder(torch.nn.Module):
+    """
+    Holds the image encoder weights in bfloat16, roughly halving its memory, the input is
+    cast down and the embedding cast back to float32 for the prompt decoder.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder.to(torch.bfloat16)
+        self.img_size = encoder.img_size
+        return
+
+    def forward(self, x):
+        return self.encoder(x.to(torch.bfloat16)).float()
+
+
+class SAMprecision():
+    """
+    Reduced precision CPU inference for the SAM image encoder, the prompt decoder is small
+    and is left in float32.
+        int8: dynamic int8 quantisation of the encoder's Linear layers, the quantised
+              weights are saved so the conversion is only paid once.
+        bf16: bfloat16 encoder weights and activations.
+    """
+
+    def __init__(self, quantDir: str=".samquant/"):
+        self.quantDir = quantDir
+        self.precisions = ["fp32", "int8", "bf16"]
+        return
+
+    def quantisedPath(self, modelType: str, checkpointPath: str) -> str:
+        name = os.path.splitext(os.path.basename(checkpointPath))[0]
+        return os.path.join(self.quantDir, f"{modelType}_{name}_int8.pt")
+
+    def quantiseEncoder(self, sam):
+        sam.image_encoder = torch.ao.quantization.quantize_dynamic(
+            sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return sam
+
+    def loadInt8(self, registry: dict, modelType: str, checkpointPath: str):
+        """
+        Returns the int8 model, from the saved weights when they exist. The model is built
+        without a checkpoint and the saved state loaded over it, so the float32 checkpoint
+        is not read again.
+        """
+        path = self.quantisedPath(modelType, checkpointPath)
+        if os.path.isfile(path):
+            print(f"Loading int8 weights: {path}")
+            sam = self.quantiseEncoder(registry[modelType](checkpoint=None))
+            sam.load_state_dict(torch.load(path, map_location="cpu"))
+            return sam.eval()
+
+        print(f"Quantising the {modelType} image encoder to int8, this is only done once")
+        sam = self.quantiseEncoder(registry[modelType](checkpoint=checkpointPath).eval())
+        if not os.path.isdir(self.quantDir):
+            os.makedirs(self.quantDir, exist_ok=True)
+        torch.save(sam.state_dict(), path)
+        print(f"int8 weights saved to: {path}")
+        return sam
+
+    def applyBF16(self, sam):
+        sam.image_encoder = BF16Encoder(sam.image_encoder)
+        return sam
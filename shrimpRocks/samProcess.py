@@ -3,8 +3,6 @@
 
 import cv2
 import numpy as np
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
-import torch
 import os
 import sys
 
@@ -16,28 +14,365 @@ import sys
 # sudo pip install torch torchvision torchaudio
 
 from shrimpRocks.imgFilters import ImageFilters
+from shrimpRocks.samCache import MaskCache, EmbeddingCache
+from shrimpRocks.maskSet import MaskSet
+from shrimpRocks.imgUtilities import ImageUtilities
+from shrimpRocks.samServer import SAMclient, defaultAddress
+
+# torch, segment_anything and the modules that use them are imported where the model is
+# needed, so a command answered from the mask cache or a running server starts quickly
         
 class SAMprocess:
 
-    def __init__(self):
-        self.checkpointPath = "sam_vit_h_4b8939.pth"  # use the checkpoint you have
-        self.modelType = "vit_h"        
+    def __init__(self, settings: dict=None):
         self.windowName = 'Interactive Segmentation'
-        self.llmPath = "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth"
+        
+        ## the backbones that can be used, with the checkpoint file and where to download it from.
+        # vit_t is the MobileSAM TinyViT encoder, it needs: pip install git+https://github.com/ChaoningZhang/MobileSAM.git
+        self.checkpoints = {
+            "vit_h": ("sam_vit_h_4b8939.pth", "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth"),
+            "vit_l": ("sam_vit_l_0b3195.pth", "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth"),
+            "vit_b": ("sam_vit_b_01ec64.pth", "https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth"),
+            "vit_t": ("mobile_sam.pt", "https://github.com/ChaoningZhang/MobileSAM/raw/master/weights/mobile_sam.pt")
+        }
+        
+        ## these are the default values, any can be replaced with the settings parameter
+        self.settings = {
+            "USE_CACHE": True,              # get_masks, read and write the on-disk mask cache
+            "CACHE_DIR": ".samcache/",      # MaskCache, where the cached masks are kept
+            "CACHE_MAX_MB": 2048,           # MaskCache, least recently used entries are evicted above this
+            "USE_EMBED_CACHE": True,        # generate_masks, reuse saved image encoder output
+            "EMBED_CACHE_DIR": ".samembed/",    # EmbeddingCache, where the encoder output is kept
+            "EMBED_CACHE_MAX_MB": 4096,     # EmbeddingCache, about 4MB per image
+            "USE_SERVER": True,             # get_masks, send requests to a running SAMserver
+            "SERVER_ADDRESS": defaultAddress(), # SAMserver, Unix socket path or localhost:port
+            "PRESET": "default",            # SamAutomaticMaskGenerator settings, one of self.presets
+            "GENERATOR_OVERRIDES": {},      # SamAutomaticMaskGenerator settings that replace those in the preset
+            "MODEL_TYPE": "vit_h",          # load_model, one of self.checkpoints
+            "CHECKPOINT": None,             # load_model, a checkpoint file for MODEL_TYPE, None uses the one in self.checkpoints
+            "RUNTIME": "torch",             # load_sam, torch or onnx (ONNX Runtime on the CPU, see samOnnx.py)
+            "ONNX_DIR": ".samonnx/",        # SAMonnx, where the exported encoder and decoder are kept
+            "PRECISION": "fp32",            # load_model, fp32, int8 or bf16 for the image encoder, see samPrecision.py
+            "QUANT_DIR": ".samquant/",      # SAMprecision, where the int8 weights are saved
+            "CPU_TUNE": False,              # load_model, thread, memory layout and inference mode settings for the CPU, see samTuning.py
+            "COMPILE": False,               # load_model, torch.compile the image encoder, implies CPU_TUNE
+            "COMPILE_DIR": ".samcompile/",  # SAMtuning, where the compiled encoder is cached
+            "PROMPT": "grid"                # load_sam, grid (the generator's points_per_side grid) or seeded (WatershedProcess.seedPoints)
+        }
+        if settings:
+            self.settings.update(settings)
+        self.setModel(self.settings["MODEL_TYPE"], self.settings["CHECKPOINT"])
+        
+        ## SamAutomaticMaskGenerator speed/quality trade-offs, on the CPU the number of points
+        # (points_per_side squared) and the crop layers dominate the run time. 
+        self.presets = {
+            "default": {},    # the library defaults, 32x32 points, no crop layers
+            "fast": {
+                "points_per_side": 16,
+                "points_per_batch": 128,
+                "pred_iou_thresh": 0.86,
+                "stability_score_thresh": 0.92,
+                "crop_n_layers": 0,
+                "min_mask_region_area": 0
+            },
+            "balanced": {
+                "points_per_side": 24,
+                "points_per_batch": 96,
+                "pred_iou_thresh": 0.88,
+                "stability_score_thresh": 0.94,
+                "crop_n_layers": 0,
+                "min_mask_region_area": 100
+            },
+            "thorough": {
+                "points_per_side": 32,
+                "points_per_batch": 64,
+                "pred_iou_thresh": 0.88,
+                "stability_score_thresh": 0.95,
+                "crop_n_layers": 1,
+                "crop_n_points_downscale_factor": 2,
+                "min_mask_region_area": 100
+            }
+        }
+        
+        ## passed to SamAutomaticMaskGenerator
+        self.generatorParams = self.makeGeneratorParams(self.settings["PRESET"], self.settings["GENERATOR_OVERRIDES"])
+        
+        self.maskCache = None
+        if self.settings["USE_CACHE"]:
+            self.maskCache = MaskCache(self.settings["CACHE_DIR"], self.settings["CACHE_MAX_MB"])
+        self.embeddingCache = None
+        if self.settings["USE_EMBED_CACHE"]:
+            self.embeddingCache = EmbeddingCache(self.settings["EMBED_CACHE_DIR"], self.settings["EMBED_CACHE_MAX_MB"])
+        self.mask_generator = None
+        # where load_model put the model, cpu or cuda
+        self.device = None
+        self.samTuning = None
+        self.modelCalls = 0
+        self.seeder = None
+        self.samClient = None
+        # the server runs the torch model with the point grid
+        if self.settings["USE_SERVER"] and self.settings["RUNTIME"] == "torch" and self.settings["PROMPT"] == "grid":
+            self.samClient = SAMclient(self.settings["SERVER_ADDRESS"])
               
-    def load_sam(self):
+    def makeGeneratorParams(self, preset: str, overrides: dict=None) -> dict:
+        """
+        The preset's SamAutomaticMaskGenerator settings with any overrides applied.
+        """
+        if preset not in self.presets:
+            print(f"Unknown mask generator preset: {preset}, available: {', '.join(self.presets)}")
+            sys.exit()
+        
+        params = dict(self.presets[preset])
+        if overrides:
+            params.update({k: v for k, v in overrides.items() if v is not None})
+        return params
+    
+    def cacheParams(self) -> dict:
+        """
+        The generator settings that change the masks, points_per_batch only changes the speed.
+        """
+        params = {k: v for k, v in self.generatorParams.items() if k != "points_per_batch"}
+        if self.settings["PROMPT"] != "grid":
+            params["prompt"] = self.settings["PROMPT"]
+        return params
+
+    def setModel(self, modelType: str, checkpointPath: str=None):
+        """
+        Choose the backbone, by default the checkpoint is looked for where the program is run from.
+        """
+        if modelType not in self.checkpoints:
+            print(f"Unknown model type: {modelType}, available: {', '.join(self.checkpoints)}")
+            sys.exit()
+        
+        self.modelType = modelType
+        self.checkpointPath, self.llmPath = self.checkpoints[modelType]
+        if checkpointPath:
+            self.checkpointPath = checkpointPath
+        return
+    
+    def modelKey(self) -> str:
+        """
+        Identifies the model in the mask cache, so that different backbones or checkpoints
+        do not share entries.
+        """
+        key = f"{self.modelType}:{os.path.basename(self.checkpointPath)}"
+        if self.settings["RUNTIME"] != "torch":
+            key = f"{key}:{self.settings['RUNTIME']}"
+        elif self.settings["PRECISION"] != "fp32":
+            key = f"{key}:{self.settings['PRECISION']}"
+        return key
+    
+    def modelRegistry(self) -> dict:
+        
+        from segment_anything import sam_model_registry
+        
+        if self.modelType in sam_model_registry:
+            return sam_model_registry
+        
+        try:
+            from mobile_sam import sam_model_registry as mobile_sam_registry
+        except ImportError:
+            print(f"The {self.modelType} model needs MobileSAM: pip install git+https://github.com/ChaoningZhang/MobileSAM.git")
+            sys.exit()
+        return mobile_sam_registry
+
+    def load_model(self):
         # Initialize SAM
         self.checkpointCheck(self.checkpointPath)
         
-        sam = sam_model_registry[self.modelType](checkpoint=self.checkpointPath)
+        import torch
+        from shrimpRocks.samPrecision import SAMprecision
+        
+        samPrecision = SAMprecision(self.settings["QUANT_DIR"])
+        precision = self.settings["PRECISION"]
+        if precision not in samPrecision.precisions:
+            print(f"Unknown precision: {precision}, available: {', '.join(samPrecision.precisions)}")
+            sys.exit()
+        
         # Move SAM to the appropriate device (CPU/GPU)
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        print (f"Using device: {device}")
+        
+        if precision == "int8":
+            # dynamic quantisation only runs on the CPU
+            device = "cpu"
+            sam = samPrecision.loadInt8(self.modelRegistry(), self.modelType, self.checkpointPath)
+        else:
+            print(f"Loading model: {self.modelType} from {self.checkpointPath}")
+            sam = self.modelRegistry()[self.modelType](checkpoint=self.checkpointPath)
+            if precision == "bf16":
+                sam = samPrecision.applyBF16(sam)
+        
+        print (f"Using device: {device}, encoder precision: {precision}")
         sam.to(device=device)
+        self.device = device
+        
+        if self.settings["CPU_TUNE"] or self.settings["COMPILE"]:
+            from shrimpRocks.samTuning import SAMtuning
+            
+            self.samTuning = SAMtuning(self.settings["COMPILE_DIR"])
+            sam = self.samTuning.apply(sam, self.settings["COMPILE"])
+        return sam
+    
+    def load_sam(self, sam=None):
+        from segment_anything import SamAutomaticMaskGenerator
+        from shrimpRocks.samOnnx import SAMonnx
+        
+        generatorParams = dict(self.generatorParams)
+        if self.settings["PROMPT"] == "seeded":
+            from shrimpRocks.watershedProcess import WatershedProcess
+            
+            # the points are set for each image by promptPoints, the seeds are for the whole
+            # image so there are no crop layers
+            self.seeder = WatershedProcess(self.settings)
+            generatorParams.update(points_per_side=None, point_grids=[np.zeros((1, 2))], crop_n_layers=0)
+        
+        if self.settings["RUNTIME"] == "onnx":
+            print(f"Using ONNX Runtime: {self.modelType}")
+            samOnnx = SAMonnx(self.settings["ONNX_DIR"], self.modelType, self.checkpointPath)
+            return samOnnx.makeGenerator(generatorParams)
+        
+        if sam is None:
+            sam = self.load_model()
 
         # Initialize the mask generator
-        mask_generator = SamAutomaticMaskGenerator(sam)
+        # run length output, so SAM does not make a full frame mask for each one
+        mask_generator = SamAutomaticMaskGenerator(sam, output_mode="uncompressed_rle", **generatorParams)
         return mask_generator   
+    
+    def promptPoints(self, mask_generator, image_rgb) -> bool:
+        """
+        With PROMPT seeded, replace the generator's points with a seed point per pebble
+        found in the image. Returns False when there is nothing to prompt with.
+        """
+        if self.seeder is None:
+            return True
+        
+        seeds = self.seeder.seedPoints(image_rgb)
+        height, width = image_rgb.shape[:2]
+        gridPoints = (self.generatorParams.get("points_per_side") or 32) ** 2
+        print(f"{len(seeds)} seed points instead of a {gridPoints} point grid")
+        if len(seeds) == 0:
+            return False
+        # the generator scales the points by the image size
+        mask_generator.point_grids = [seeds / np.array([width, height], dtype=np.float64)]
+        return True
+
+    def get_masks(self, image_rgb) -> MaskSet:
+        """
+        Returns the SAM masks for an image as a MaskSet, using the mask cache when possible. On a miss
+        the masks come from a running SAMserver, otherwise the model is loaded locally the
+        first time it is needed.
+        """
+        key = None
+        if self.maskCache is not None:
+            key = self.maskCache.makeKey(image_rgb, self.modelKey(), self.cacheParams())
+            sam_masks = self.maskCache.load(key)
+            if sam_masks is not None:
+                return sam_masks
+        
+        sam_masks = None
+        if self.mask_generator is None and self.samClient is not None and self.samClient.ping():
+            try:
+                print(f"using the SAM server at: {self.samClient.address}")
+                sam_masks = self.samClient.generate(image_rgb, self.modelType, self.checkpointPath,
+                                                    self.settings["PRECISION"], self.generatorParams)
+            except (OSError, ValueError, RuntimeError) as e:
+                print(e)
+                print("falling back to loading the model locally")
+                self.samClient = None
+        
+        if sam_masks is None:
+            if self.mask_generator is None:
+                self.mask_generator = self.load_sam()
+            sam_masks = self.generate_masks(self.mask_generator, image_rgb)
+        
+        if key is not None:
+            self.maskCache.save(key, sam_masks)
+        return sam_masks
+
+    def needsModel(self, image_files: list) -> bool:
+        """
+        Whether any of the images has to go through a model loaded here, False when a
+        SAMserver is running or every image's masks are in the mask cache.
+        """
+        if self.samClient is not None and self.samClient.ping():
+            return False
+        if self.maskCache is None:
+            return True
+        
+        for image_file in image_files:
+            _, image_rgb = self.load_image(image_file)
+            key = self.maskCache.makeKey(image_rgb, self.modelKey(), self.cacheParams())
+            if not os.path.isfile(self.maskCache.entryPath(key)):
+                return True
+        return False
+
+    def get_masks_batch(self, images_rgb: list) -> list:
+        """
+        Returns a MaskSet per image, the images missing from the cache have their
+        embeddings made in a single batch by the image encoder before the masks are decoded
+        one image at a time. When a SAMserver is running the images are sent to it one at
+        a time instead, rather than loading a second copy of the model here.
+        """
+        # the ONNX encoder is exported for one image at a time
+        if len(images_rgb) == 1 or self.settings["RUNTIME"] != "torch":
+            return [self.get_masks(image_rgb) for image_rgb in images_rgb]
+        if self.mask_generator is None and self.samClient is not None and self.samClient.ping():
+            return [self.get_masks(image_rgb) for image_rgb in images_rgb]
+        
+        results = [None] * len(images_rgb)
+        keys = [None] * len(images_rgb)
+        if self.maskCache is not None:
+            for i, image_rgb in enumerate(images_rgb):
+                keys[i] = self.maskCache.makeKey(image_rgb, self.modelKey(), self.cacheParams())
+                results[i] = self.maskCache.load(keys[i])
+        
+        missing = [i for i in range(len(images_rgb)) if results[i] is None]
+        if not missing:
+            return results
+        
+        if self.mask_generator is None:
+            self.mask_generator = self.load_sam()
+        
+        from shrimpRocks.samEmbedding import SAMembedding
+        
+        samEmbed = SAMembedding()
+        predictor = self.mask_generator.predictor
+        embeddings = {}
+        if self.embeddingCache is not None:
+            for i in missing:
+                features = self.embeddingCache.load(self.embeddingCache.makeKey(images_rgb[i], self.modelKey()))
+                if features is not None:
+                    embeddings[i] = samEmbed.embeddingFromArray(predictor, features, images_rgb[i])
+        
+        encode = [i for i in missing if i not in embeddings]
+        if encode:
+            encoded = self.runModel(f"{len(encode)} images", samEmbed.embedImages, predictor.model,
+                                    [images_rgb[i] for i in encode])
+            for i, embedding in zip(encode, encoded):
+                embeddings[i] = embedding
+                if self.embeddingCache is not None:
+                    embedKey = self.embeddingCache.makeKey(images_rgb[i], self.modelKey())
+                    self.embeddingCache.save(embedKey, samEmbed.featuresToArray(embedding))
+        
+        for i in missing:
+            sam_masks = []
+            if self.promptPoints(self.mask_generator, images_rgb[i]):
+                sam_masks = self.runModel("image", samEmbed.generate, self.mask_generator, images_rgb[i], embeddings[i])
+            results[i] = MaskSet.fromSamMasks(sam_masks, images_rgb[i].shape)
+            if keys[i] is not None:
+                self.maskCache.save(keys[i], results[i])
+        return results
+
+    def exportOnnx(self):
+        """
+        Write the ONNX encoder and decoder for the current model, used by RUNTIME onnx.
+        """
+        from shrimpRocks.samOnnx import SAMonnx
+        
+        samOnnx = SAMonnx(self.settings["ONNX_DIR"], self.modelType, self.checkpointPath)
+        samOnnx.exportModels(self.load_model())
+        return
 
     def checkpointCheck(self, checkpointFile):        
         cwd = os.getcwd()        
@@ -57,35 +392,52 @@ class SAMprocess:
         return image, image_rgb
 
 
-    def generate_masks(self, mask_generator, image_rgb):
-        """Generates all masks using SAM's automatic mask generator."""
-        # The output is a list of dictionaries, each containing a segmentation mask
-        sam_masks = mask_generator.generate(image_rgb)
-        return sam_masks
-
-    def makeOutputImage(self, image, filtered_masks):
-        """Draws the selected masks on the image and updates the specified window."""
-        output_image = image.copy()
+    def get_embedding(self, predictor, image_rgb) -> dict:
+        """
+        The image encoder output for an image, from the embedding cache when it has been
+        seen before with this model, otherwise the encoder is run and the result saved.
+        """
+        from shrimpRocks.samEmbedding import SAMembedding
         
-        outline_color = (0, 0, 255)  
-        outline_thickness = 2        
-        fill_color = (0, 255, 0) 
-    
-        overlay = np.zeros_like(output_image, dtype=np.uint8)
+        samEmbed = SAMembedding()
+        key = self.embeddingCache.makeKey(image_rgb, self.modelKey())
+        features = self.embeddingCache.load(key)
+        if features is not None:
+            return samEmbed.embeddingFromArray(predictor, features, image_rgb)
         
-        # 1. Draw Fill
-        for mask_data in filtered_masks:
-            mask = mask_data['segmentation']
-            overlay[mask] = fill_color
+        embedding = samEmbed.encodeImage(predictor, image_rgb)
+        self.embeddingCache.save(key, samEmbed.featuresToArray(embedding))
+        return embedding
 
-        alpha = 0.5 
-        output_image = cv2.addWeighted(output_image, 1 - alpha, overlay, alpha, 0)
+    def runModel(self, label: str, func, *args):
+        """
+        Calls func, in the CPU tuning mode under torch.inference_mode with the encoder and
+        decoder times printed.
+        """
+        if self.samTuning is None:
+            return func(*args)
+        self.modelCalls += 1
+        return self.samTuning.timed(f"{label} {self.modelCalls}", func, *args)
 
-        # 2. Draw Outline
-        for mask_data in filtered_masks:
-            mask = mask_data['segmentation'].astype(np.uint8) * 255
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(output_image, contours, -1, outline_color, outline_thickness)
+    def samGenerate(self, mask_generator, image_rgb) -> list:
+        # The output is a list of dictionaries, each containing a segmentation mask
+        if not self.promptPoints(mask_generator, image_rgb):
+            return []
+        if self.embeddingCache is None:
+            return mask_generator.generate(image_rgb)
+        
+        # only the prompt decoder runs when the image embedding is cached
+        from shrimpRocks.samEmbedding import SAMembedding
+        
+        embedding = self.get_embedding(mask_generator.predictor, image_rgb)
+        return SAMembedding().generate(mask_generator, image_rgb, embedding)
 
-        return output_image
+    def generate_masks(self, mask_generator, image_rgb) -> MaskSet:
+        """Generates all masks using SAM's automatic mask generator."""
+        sam_masks = self.runModel("image", self.samGenerate, mask_generator, image_rgb)
+        return MaskSet.fromSamMasks(sam_masks, image_rgb.shape)
+
+    def makeOutputImage(self, image, filtered_masks):
+        """Draws the selected masks on the image and updates the specified window."""
+        return ImageUtilities().drawMasks(image, filtered_masks)
 
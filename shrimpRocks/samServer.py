@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import struct
+import socketserver
+import numpy as np
+
+from shrimpRocks.samCache import MaskCache
+
+
+def _sendFrame(sock, data: bytes):
+    sock.sendall(struct.pack(">Q", len(data)) + data)
+
+def _recvExact(sock, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed by the SAM server")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def _recvFrame(sock) -> bytes:
+    (size,) = struct.unpack(">Q", _recvExact(sock, 8))
+    return _recvExact(sock, size)
+
+def parseAddress(address: str) -> tuple:
+    """
+    "host:port" is a TCP address on this machine, anything else is a Unix socket path.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+def defaultAddress() -> str:
+    if hasattr(socket, "AF_UNIX"):
+        return ".samserver.sock"
+    return "127.0.0.1:50707"
+
+
+class SAMclient():
+    """
+    Sends mask generation requests to a running SAMserver, each request is a JSON header
+    frame followed by the raw RGB image bytes, the reply is a JSON header frame followed
+    by the masks packed by MaskCache.
+    """
+
+    def __init__(self, address: str=None):
+        self.address = address or defaultAddress()
+        self.packer = MaskCache()
+        return
+
+    def _connect(self, timeout: float=None):
+        family, addr = parseAddress(self.address)
+        if family == socket.AF_UNIX and not os.path.exists(addr):
+            return None
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(addr)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def _request(self, header: dict, payload: bytes=b"", timeout: float=None) -> tuple:
+        sock = self._connect(timeout)
+        if sock is None:
+            return None, None
+        with sock:
+            _sendFrame(sock, json.dumps(header).encode())
+            _sendFrame(sock, payload)
+            reply = json.loads(_recvFrame(sock).decode())
+            data = _recvFrame(sock)
+        return reply, data
+
+    def ping(self) -> bool:
+        """
+        True when a server is listening at the address.
+        """
+        try:
+            reply, _ = self._request({"cmd": "ping"}, timeout=2.0)
+        except (OSError, ValueError):
+            return False
+        return reply is not None and reply.get("ok", False)
+
+    def generate(self, image_rgb: np.ndarray, modelType: str, checkpointPath: str, precision: str, params: dict):
+        """
+        Returns the SAM masks for the image as a MaskSet, raises RuntimeError when the server fails.
+        """
+        image_rgb = np.ascontiguousarray(image_rgb, dtype=np.uint8)
+        header = {
+            "cmd": "generate",
+            "shape": list(image_rgb.shape),
+            "modelType": modelType,
+            "checkpointPath": os.path.abspath(checkpointPath),
+            "precision": precision,
+            "params": params
+        }
+        reply, data = self._request(header, image_rgb.tobytes())
+        if reply is None:
+            raise RuntimeError(f"SAM server not reachable at {self.address}")
+        if not reply.get("ok", False):
+            raise RuntimeError(f"SAM server error: {reply.get('error')}")
+        return self.packer.bytesToMasks(data)
+
+    def shutdown(self) -> bool:
+
+        try:
+            reply, _ = self._request({"cmd": "shutdown"}, timeout=5.0)
+        except (OSError, ValueError):
+            return False
+        return reply is not None
+
+
+class SAMserver():
+    """
+    Keeps the SAM model loaded in memory and answers SAMclient requests one at a time,
+    so the checkpoint is only loaded once per session rather than once per command.
+    Checkpoints are unpickled when they are loaded, so only the one the server was started
+    with, and any passed in checkpoints, are loaded, requests for any other are refused.
+    """
+
+    def __init__(self, samProc, address: str=None, checkpoints: list=None):
+        self.samProc = samProc
+        self.address = address or defaultAddress()
+        self.checkpoints = {os.path.abspath(path) for path in checkpoints or []}
+        self.packer = MaskCache()
+        self.models = {}        # (modelType, checkpointPath, precision): sam model on its device
+        self.generators = {}    # (modelType, checkpointPath, precision, params): mask generator
+        return
+
+    def getGenerator(self, modelType: str, checkpointPath: str, precision: str, params: dict):
+        """
+        Generators are cheap wrappers around the model, so one is kept per parameter set.
+        samProc is set to the requested model every time, even for a kept generator, as its
+        embedding cache is keyed on the model and precision.
+        """
+        modelKey = (modelType, checkpointPath, precision)
+        genKey = modelKey + (json.dumps(params, sort_keys=True),)
+        self.samProc.setModel(modelType, checkpointPath)
+        self.samProc.settings["PRECISION"] = precision
+        self.samProc.generatorParams = params
+        if genKey in self.generators:
+            return self.generators[genKey]
+
+        if modelKey not in self.models:
+            self.models[modelKey] = self.samProc.load_model()
+
+        self.generators[genKey] = self.samProc.load_sam(self.models[modelKey])
+        return self.generators[genKey]
+
+    def handle(self, sock) -> bool:
+        """
+        Serve one request, returns False when the server has been asked to stop.
+        """
+        header = json.loads(_recvFrame(sock).decode())
+        payload = _recvFrame(sock)
+        cmd = header.get("cmd")
+
+        if cmd == "ping":
+            _sendFrame(sock, json.dumps({"ok": True, "models": [list(k) for k in self.models]}).encode())
+            _sendFrame(sock, b"")
+            return True
+
+        if cmd == "shutdown":
+            _sendFrame(sock, json.dumps({"ok": True}).encode())
+            _sendFrame(sock, b"")
+            return False
+
+        if cmd != "generate":
+            _sendFrame(sock, json.dumps({"ok": False, "error": f"unknown command: {cmd}"}).encode())
+            _sendFrame(sock, b"")
+            return True
+
+        try:
+            start = time.perf_counter()
+            shape = tuple(header["shape"])
+            image_rgb = np.frombuffer(payload, dtype=np.uint8).reshape(shape)
+            checkpointPath = os.path.abspath(header["checkpointPath"])
+            if checkpointPath not in self.checkpoints:
+                raise PermissionError(f"checkpoint not served: {checkpointPath}")
+            mask_generator = self.getGenerator(header["modelType"], checkpointPath,
+                                               header.get("precision", "fp32"), header["params"])
+            sam_masks = self.samProc.generate_masks(mask_generator, image_rgb)
+            data = self.packer.masksToBytes(sam_masks)
+            print(f"generated {len(sam_masks)} masks in {time.perf_counter() - start:.1f}s")
+        except (Exception, SystemExit) as e:
+            # SystemExit comes from SAMprocess when a model or checkpoint is not available
+            _sendFrame(sock, json.dumps({"ok": False, "error": str(e) or type(e).__name__}).encode())
+            _sendFrame(sock, b"")
+            return True
+
+        _sendFrame(sock, json.dumps({"ok": True}).encode())
+        _sendFrame(sock, data)
+        return True
+
+    def serve(self):
+        """
+        Load the default model and serve until a shutdown request or Ctrl-C.
+        """
+        family, addr = parseAddress(self.address)
+        if SAMclient(self.address).ping():
+            print(f"a SAM server is already running at: {self.address}")
+            return
+
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)  # stale socket left by a server that did not exit cleanly
+
+        checkpointPath = os.path.abspath(self.samProc.checkpointPath)
+        self.checkpoints.add(checkpointPath)
+        self.getGenerator(self.samProc.modelType, checkpointPath,
+                          self.samProc.settings["PRECISION"], self.samProc.generatorParams)
+
+        server = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                try:
+                    if not server.handle(self.request):
+                        self.server.stopping = True
+                except (OSError, ValueError) as e:
+                    print(f"request failed: {e}")
+
+        serverClass = socketserver.UnixStreamServer if family == socket.AF_UNIX else socketserver.TCPServer
+        with serverClass(addr, Handler) as srv:
+            srv.stopping = False
+            print(f"SAM server listening on: {self.address}, press Ctrl-C to stop")
+            try:
+                while not srv.stopping:
+                    srv.handle_request()
+            except KeyboardInterrupt:
+                pass
+
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        print("SAM server stopped")
+        return
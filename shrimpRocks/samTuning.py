@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import torch
+
+
+class SAMtuning():
+    """
+    CPU execution settings for the torch model, and timing of the image encoder against
+    the rest of the mask generation (the prompt encoder, mask decoder and post processing).
+        threads:    intra-op threads from the cores this process may run on, which can be
+                    fewer than torch's default in a container or with taskset.
+        channels:   channels last layout for the encoder's convolutions and its input.
+        compile:    torch.compile of the image encoder. Compiling takes a while, the
+                    compiled code is kept in compileDir so later runs start faster.
+    """
+
+    def __init__(self, compileDir: str=".samcompile/"):
+        self.compileDir = compileDir
+        self.encoderSeconds = 0.0
+        self._encoderStart = None
+        return
+
+    def threadCount(self) -> int:
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            # not available on macOS
+            return os.cpu_count() or 1
+
+    def setThreads(self):
+        threads = self.threadCount()
+        torch.set_num_threads(threads)
+        try:
+            # the encoder is one long chain of ops, so there is nothing to run alongside it
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # can only be set before any parallel work has started
+            pass
+        return threads
+
+    def _toChannelsLast(self, module, args):
+        x = args[0]
+        if x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return (x,) + tuple(args[1:])
+
+    def _startEncoder(self, module, args):
+        self._encoderStart = time.perf_counter()
+        return
+
+    def _stopEncoder(self, module, args, output):
+        self.encoderSeconds += time.perf_counter() - self._encoderStart
+        return
+
+    def compileEncoder(self, sam):
+        """
+        Compile the image encoder and run it once, that first run is where the compiling
+        happens. Returns the model unchanged if torch.compile does not work here.
+        """
+        if not os.path.isdir(self.compileDir):
+            os.makedirs(self.compileDir, exist_ok=True)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(self.compileDir)
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+
+        encoder = sam.image_encoder
+        size = encoder.img_size
+        compiled = torch.compile(encoder)
+        compiled.img_size = size
+        print("compiling the image encoder, this is slow the first time")
+        start = time.perf_counter()
+        try:
+            with torch.inference_mode():
+                compiled(torch.zeros((1, 3, size, size), device=sam.device))
+        except Exception as e:
+            print(f"torch.compile failed, running the encoder uncompiled: {e}")
+            return sam
+        print(f"encoder warm-up: {time.perf_counter() - start:.1f}s")
+        sam.image_encoder = compiled
+        return sam
+
+    def apply(self, sam, compile: bool=False):
+        """
+        Returns the model set up for CPU inference, with timing hooks on the image encoder.
+        """
+        threads = self.setThreads()
+        sam.eval()
+        sam.image_encoder.to(memory_format=torch.channels_last)
+        sam.image_encoder.register_forward_pre_hook(self._toChannelsLast)
+        if compile:
+            sam = self.compileEncoder(sam)
+        sam.image_encoder.register_forward_pre_hook(self._startEncoder)
+        sam.image_encoder.register_forward_hook(self._stopEncoder)
+        print(f"CPU tuning: {threads} threads, channels last{', compiled encoder' if compile else ''}")
+        return sam
+
+    def timed(self, label: str, func, *args):
+        """
+        Run func in inference mode and print how long the encoder and the rest took.
+        """
+        self.encoderSeconds = 0.0
+        start = time.perf_counter()
+        with torch.inference_mode():
+            result = func(*args)
+        total = time.perf_counter() - start
+        print(f"{label} encoder: {self.encoderSeconds:.2f}s, decoder: {total - self.encoderSeconds:.2f}s")
+        return result
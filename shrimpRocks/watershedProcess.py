@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cv2
+import numpy as np
+
+from shrimpRocks.maskSet import MaskSet
+from shrimpRocks.imgTests import ImageTests
+from shrimpRocks.imgUtilities import ImageUtilities
+
+
+class WatershedProcess():
+    """
+    A segmenter with the same methods as SAMprocess that finds the pebbles with the
+    classical LAB/CLAHE, Otsu, distance transform and watershed segmenter in
+    ImageTests.segment_pebbles. It runs in a fraction of a second on the CPU and needs
+    no model, the masks are made as a MaskSet so they go through the same filters.
+    """
+
+    def __init__(self, settings: dict=None):
+
+        ## these are the default values, any can be replaced with the settings parameter
+        self.settings = {
+            "MIN_AREA_PX": 100,         # segment_pebbles, smaller regions are dropped
+            "SEED_SPACING": 7,          # seedPoints, radius in pixels a seed must be the furthest from the background within
+            "SEED_MIN_RADIUS": 3        # seedPoints, no seeds closer than this to the background
+        }
+        if settings:
+            self.settings.update({k: v for k, v in settings.items() if k in self.settings})
+        self.imageTests = ImageTests(None)
+        # nothing to load, kept so the callers can treat both backends the same
+        self.mask_generator = None
+        return
+
+    def load_image(self, image_path):
+        """Loads the image, returns it as BGR and RGB."""
+        image = cv2.imread(image_path)
+        if image is None:
+            raise FileNotFoundError(f"Could not load image at {image_path}")
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image, image_rgb
+
+    def generate(self, image_rgb) -> MaskSet:
+        """The masks for an image, one per watershed region, see MaskSet.fromLabels."""
+        image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
+        labels = self.imageTests.segment_pebbles(image_bgr, self.settings["MIN_AREA_PX"])
+        return MaskSet.fromLabels(labels)
+
+    def seedPoints(self, image_rgb) -> np.ndarray:
+        """
+        One (x, y) point per likely pebble, the peaks of the distance to the background in
+        segment_pebbles' foreground mask. Unlike its sure foreground, which is a fraction of
+        the largest distance in the image, a small pebble next to large ones still gets a seed.
+        """
+        image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
+        clean, _, _ = self.imageTests.pebbleMarkers(image_bgr)
+        dist = cv2.distanceTransform(clean, cv2.DIST_L2, 5)
+
+        size = 2 * self.settings["SEED_SPACING"] + 1
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        peaks = (dist >= cv2.dilate(dist, kernel)) & (dist >= self.settings["SEED_MIN_RADIUS"])
+
+        # a flat topped peak is several pixels, take the middle of each
+        count, _, _, centroids = cv2.connectedComponentsWithStats(peaks.astype(np.uint8))
+        return centroids[1:count].astype(np.float64)
+
+    def load_sam(self):
+        # there is no model, see SAMprocess.load_sam
+        return None
+
+    def generate_masks(self, mask_generator, image_rgb) -> MaskSet:
+        return self.generate(image_rgb)
+
+    def get_masks(self, image_rgb) -> MaskSet:
+        return self.generate_masks(None, image_rgb)
+
+    def get_masks_batch(self, images_rgb: list) -> list:
+        return [self.get_masks(image_rgb) for image_rgb in images_rgb]
+
+    def makeOutputImage(self, image, filtered_masks):
+        """Draws the selected masks on the image, the same as SAMprocess."""
+        return ImageUtilities().drawMasks(image, filtered_masks)
+
+
+def makeSegmenter(settings: dict=None):
+    """
+    The segmenter for settings["BACKEND"], "sam" (the default) or "watershed".
+    """
+    settings = settings or {}
+    backend = settings.get("BACKEND", "sam")
+    if backend == "watershed":
+        return WatershedProcess(settings)
+
+    from shrimpRocks.samProcess import SAMprocess
+
+    return SAMprocess(settings)
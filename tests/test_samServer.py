@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+import numpy as np
+
+from shrimpRocks.samProcess import SAMprocess
+from shrimpRocks.samServer import SAMserver, _sendFrame, _recvFrame
+
+
+class FakeSAMprocess(SAMprocess):
+    """
+    SAMprocess without the model, each generate records the key the embedding cache
+    would be read and written under and the generator it was given.
+    """
+
+    def __init__(self, settings: dict=None):
+        super().__init__(settings)
+        self.calls = []
+        return
+
+    def load_model(self):
+        return (self.modelType, self.settings["PRECISION"])
+
+    def load_sam(self, sam=None):
+        return {"model": sam}
+
+    def samGenerate(self, mask_generator, image_rgb) -> list:
+        self.calls.append((self.modelKey(), mask_generator["model"]))
+        return []
+
+
+def request(server, checkpointPath: str, precision: str) -> dict:
+    client, conn = socket.socketpair()
+    image_rgb = np.zeros((4, 4, 3), dtype=np.uint8)
+    header = {"cmd": "generate", "shape": list(image_rgb.shape), "modelType": "vit_b",
+              "checkpointPath": checkpointPath, "precision": precision, "params": {}}
+    _sendFrame(client, json.dumps(header).encode())
+    _sendFrame(client, image_rgb.tobytes())
+    server.handle(conn)
+    reply = json.loads(_recvFrame(client).decode())
+    client.close()
+    conn.close()
+    return reply
+
+
+def test_cached_generator_uses_its_own_model_key(tmp_path):
+    checkpointPath = str(tmp_path / "vitb.pth")
+    samProc = FakeSAMprocess({"USE_SERVER": False, "USE_CACHE": False, "USE_EMBED_CACHE": False})
+    server = SAMserver(samProc, str(tmp_path / "sam.sock"), [checkpointPath])
+
+    for precision in ("fp32", "bf16", "fp32"):
+        assert request(server, checkpointPath, precision)["ok"]
+
+    assert samProc.calls == [
+        ("vit_b:vitb.pth", ("vit_b", "fp32")),
+        ("vit_b:vitb.pth:bf16", ("vit_b", "bf16")),
+        ("vit_b:vitb.pth", ("vit_b", "fp32"))
+    ]
+
+
+def test_unknown_checkpoint_is_refused(tmp_path):
+    samProc = FakeSAMprocess({"USE_SERVER": False, "USE_CACHE": False, "USE_EMBED_CACHE": False})
+    server = SAMserver(samProc, str(tmp_path / "sam.sock"), [str(tmp_path / "vitb.pth")])
+
+    reply = request(server, str(tmp_path / "other.pth"), "fp32")
+    assert not reply["ok"]
+    assert samProc.calls == []